@@ -6,6 +6,11 @@ import time
 import signal
 import settings
 from console.config import config
+from console.exceptions import ConsoleException
+from console.adbclient import adb_client, AdbError, AdbConnectionError
+from console.probes import ProbeTimeout, wait_until, bringup
+from console.decoder import use_inprocess
+from console.capture import get_profile
 
 
 config.add_option("adb:device", type=str, default=settings.ADB_DEVICE)
@@ -27,14 +32,24 @@ def log_out_before_stop_word(process, name, word):
 
 
 class ProcessWatch(threading.Thread):
-    def __init__(self, *args, name, process, **kwargs):
+    """Logs process output, sets `ready` when `ready_word` is printed."""
+
+    def __init__(self, *args, name, process, ready_word=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.process_name = name
         self.process = process
+        self.ready_word = ready_word
+        self.ready = threading.Event()
 
     def run(self):
-        code = log_out_before_stop_word(self.process, self.process_name, "")
-        logger.info("%s: stopped with code %d", self.process_name, code)
+        if self.ready_word:
+            code = log_out_before_stop_word(self.process, self.process_name, self.ready_word)
+            if code is True:
+                self.ready.set()
+                code = log_out_before_stop_word(self.process, self.process_name, "")
+        else:
+            code = log_out_before_stop_word(self.process, self.process_name, "")
+        logger.info("%s: stopped with code %s", self.process_name, code)
 
 
 def run_command_ex(args):
@@ -51,7 +66,23 @@ def run_command(args):
     return run_command_ex(args)[0]
 
 
+def with_fallback(func, fallback, error_result=False):
+    # talk to the adb server directly, spawn adb only if it is not running
+    try:
+        return func()
+    except AdbConnectionError as e:
+        logger.info("%s, falling back to adb executable", e.msg)
+        return fallback()
+    except (AdbError, OSError) as e:
+        logger.error("adb: %s", e)
+        return error_result
+
+
 def get_attached_devices():
+    return with_fallback(adb_client.devices, get_attached_devices_ex, None)
+
+
+def get_attached_devices_ex():
     success, output = run_command_ex(["adb", "devices"])
     if not success:
         return
@@ -67,39 +98,67 @@ def get_attached_devices():
     return ret
 
 
-def connect_to_device():
+def connect_to_device(serial=None):
     output = get_attached_devices()
     if output is None:
         logger.error("Can't get list of connected devices.")
         return False
-    adb_device = config.get("adb:device")
+    adb_device = serial or config.get("adb:device")
     connected = adb_device in [x[0] for x in output]
     if not connected:
-        success, output = run_command_ex(["adb", "connect", adb_device])
-        if not success or "failed" in output:
+        success, output = with_fallback(
+            lambda: (True, adb_client.connect(adb_device)),
+            lambda: run_command_ex(["adb", "connect", adb_device]),
+            (False, "")
+        )
+        if output:
+            logger.info(output.strip())
+        if not success or "failed" in output or "cannot" in output:
             logger.error("Can't connect to device (start Nox or Bluestacks).")
             return False
     return True
 
 
-def push_server():
+def push_server(serial=None):
+    return with_fallback(
+        lambda: adb_client.push(
+            serial or config.get("adb:device"),
+            settings.ADB_SERVER_FILENAME,
+            settings.ADB_DEVICE_SERVER_PATH
+        ),
+        lambda: push_server_ex(serial)
+    )
+
+
+def push_server_ex(serial=None):
     return run_command([
         "adb",
         "-s",
-        config.get("adb:device"),
+        serial or config.get("adb:device"),
         "push",
         settings.ADB_SERVER_FILENAME,
         settings.ADB_DEVICE_SERVER_PATH
     ])
 
 
-def enable_tunnel():
+def enable_tunnel(serial=None, port=settings.SERVER_PORT):
+    return with_fallback(
+        lambda: adb_client.forward(
+            serial or config.get("adb:device"),
+            f"tcp:{port}",
+            f"localabstract:{settings.ADB_SOCKET_NAME}"
+        ),
+        lambda: enable_tunnel_ex(serial, port)
+    )
+
+
+def enable_tunnel_ex(serial=None, port=settings.SERVER_PORT):
     return run_command([
         "adb",
         "-s",
-        config.get("adb:device"),
+        serial or config.get("adb:device"),
         "forward",
-        f"tcp:{settings.SERVER_PORT}",
+        f"tcp:{port}",
         f"localabstract:{settings.ADB_SOCKET_NAME}"
     ])
 
@@ -118,22 +177,23 @@ def execute_process(args):
                             encoding="utf-8")
 
 
-def execute_server():
+def execute_server(serial=None, profile=None):
+    max_size, bit_rate, max_fps, crop = (profile or get_profile()).server_args()
     args = [
         "adb",
         "-s",
-        config.get("adb:device"),
+        serial or config.get("adb:device"),
         "shell",
         f"CLASSPATH={settings.ADB_DEVICE_SERVER_PATH}",
         "app_process",
         "/",
         "com.genymobile.scrcpy.Server",
         "1.12.1",
-        "0",      # maxsize
-        f"{settings.SERVER_BIT_RATE}",
-        f"{settings.SERVER_MAX_FPS}",
+        max_size,
+        bit_rate,
+        max_fps,
         "true",   # tunnel forwarding
-        "-",      # crop
+        crop,
         "true",   # always send frame meta (packet boundaries + timestamp)
         "true"    # controls
     ]
@@ -142,54 +202,143 @@ def execute_server():
     return process
 
 
-def execute_scrshare():
-    args = [
-        "scrshare",
-        "-i",
-        f"{settings.SCRSHARE_RENDER_INTERVAL}",
-        "-l",
-        f"{settings.SCRSHARE_LOG_LEVEL}",
-    ]
+def scrshare_accepts_ports():
+    return any("{server_port}" in x for x in settings.SCRSHARE_ARGS) and \
+        any("{receiver_port}" in x for x in settings.SCRSHARE_ARGS)
+
+
+def execute_scrshare(server_port=settings.SERVER_PORT, receiver_port=settings.RECEIVER_PORT):
+    if (server_port, receiver_port) != (settings.SERVER_PORT, settings.RECEIVER_PORT) and \
+            not scrshare_accepts_ports():
+        raise ConsoleException("scrshare can't use ports %d/%d, SCRSHARE_ARGS has no port placeholders" % (
+            server_port, receiver_port))
+    params = {
+        "interval": settings.SCRSHARE_RENDER_INTERVAL,
+        "log_level": settings.SCRSHARE_LOG_LEVEL,
+        "server_port": server_port,
+        "receiver_port": receiver_port,
+    }
+    args = ["scrshare"] + [arg.format(**params) for arg in settings.SCRSHARE_ARGS]
     process = execute_process(args)
+    watch = ProcessWatch(process=process, name="scrshare", ready_word="@video_server_connected", daemon=True)
+    watch.start()
     # здесь магия, сервер, что залили через adb ждет 2 соединения
     # первое - это видео поток
     # второе - это контроль
     # и вот тут надо ждать, пока scrshare не приконнектится первым, иначе пиздос
     # scrshare специально логирует @socket_connected
-    log_out_before_stop_word(process, "scrshare", "@video_server_connected")
-    ProcessWatch(process=process, name="scrshare", daemon=True).start()
+    try:
+        wait_until(lambda: watch.ready.is_set() or process.poll() is not None,
+                   settings.SCRSHARE_READY_TIMEOUT, "scrshare video stream")
+    except ProbeTimeout:
+        process.terminate()
+        raise
+    if not watch.ready.is_set():
+        raise ConsoleException("scrshare exited with code %s before connecting to the video stream" % process.poll())
     return process
 
 
-_server_proc = None
-_scrshare_proc = None
+def server_listening(serial=None):
+    # the server opens the abstract socket once it is ready for connections
+    output = adb_client.shell(serial or config.get("adb:device"), "cat /proc/net/unix")
+    return ("@" + settings.ADB_SOCKET_NAME) in output
+
+
+def wait_server_ready(timeout, serial=None):
+    try:
+        wait_until(lambda: server_listening(serial), timeout, "scrcpy server")
+    except AdbError as e:
+        # no adb server socket (fallback mode), nothing to poll
+        logger.info("can't probe scrcpy server (%s), waiting 1s", e.msg)
+        time.sleep(1.)
+
+
+class DeviceServer:
+    """scrcpy server and scrshare processes of one device, scrshare is not
+    started with the in-process decoder.
+    `serial` defaults to the "adb:device" option.
+    """
+
+    def __init__(self, serial=None, server_port=settings.SERVER_PORT, receiver_port=settings.RECEIVER_PORT):
+        self._serial = serial
+        self.server_port = server_port
+        self.receiver_port = receiver_port
+        self.server_proc = None
+        self.scrshare_proc = None
+
+    @property
+    def serial(self):
+        return self._serial or config.get("adb:device")
+
+    def kill(self):
+        if self.server_proc:
+            self.server_proc.terminate()
+        if self.scrshare_proc:
+            self.scrshare_proc.terminate()
+
+    def run(self, steps=bringup):
+        self.kill()
+        try:
+            return self._run(steps)
+        except ConsoleException:
+            # a failed probe must not leave the server running
+            self.kill()
+            raise
+
+    def _run(self, steps):
+        serial = self.serial
+        with steps.step("connect"):
+            if not connect_to_device(serial):
+                return False
+        with steps.step("push"):
+            if not push_server(serial):
+                return False
+        with steps.step("tunnel"):
+            if not enable_tunnel(serial, self.server_port):
+                return False
+        with steps.step("server"):
+            self.server_proc = execute_server(serial)
+            wait_server_ready(settings.SERVER_READY_TIMEOUT, serial)
+        if use_inprocess():
+            # the client connects to the video stream itself
+            self.scrshare_proc = None
+            return True
+        with steps.step("scrshare"):
+            self.scrshare_proc = execute_scrshare(self.server_port, self.receiver_port)
+        return True
+
+    def processes_started(self):
+        if not self.server_proc or self.server_proc.poll() is not None:
+            return False
+        if use_inprocess():
+            return True
+        return self.scrshare_proc is not None and self.scrshare_proc.poll() is None
+
+
+default_server = DeviceServer()
+_servers = [default_server]
 
 
 def kill_server():
-    if _server_proc:
-        _server_proc.terminate()
-    if _scrshare_proc:
-        _scrshare_proc.terminate()
+    default_server.kill()
+
+
+def kill_all_servers():
+    for server in _servers:
+        server.kill()
+
+
+def register_server(server):
+    atexit.unregister(kill_all_servers)
+    atexit.register(kill_all_servers)
+    if server not in _servers:
+        _servers.append(server)
 
 
 def run_server():
-    global _server_proc, _scrshare_proc
-    atexit.unregister(kill_server)
-    atexit.register(kill_server)
-    kill_server()
-    if not connect_to_device():
-        return False
-    if not push_server():
-        return False
-    if not enable_tunnel():
-        return False
-    _server_proc = execute_server()
-    time.sleep(1.)
-    _scrshare_proc = execute_scrshare()
-    return True
+    register_server(default_server)
+    return default_server.run()
 
 
 def processes_started():
-    if _server_proc and _scrshare_proc:
-        return _server_proc.poll() is None and _scrshare_proc.poll() is None
-    return False
+    return default_server.processes_started()
@@ -0,0 +1,227 @@
+import os
+import time
+import socket
+import struct
+import logging
+import threading
+import settings
+from console.exceptions import ConsoleException
+
+
+__all__ = ("AdbClient", "AdbError", "AdbConnectionError", "adb_client")
+
+
+logger = logging.getLogger(__name__)
+
+
+SYNC_DATA_MAX = 64 * 1024
+
+
+class AdbError(ConsoleException):
+    logger = "adb"
+
+
+class AdbConnectionError(AdbError):
+    pass
+
+
+class AdbConnection:
+    """One socket to the adb server speaking the host protocol."""
+
+    def __init__(self, host, port, timeout):
+        try:
+            self.sock = socket.create_connection((host, port), timeout=timeout)
+        except OSError as e:
+            raise AdbConnectionError("Can't connect to adb server %s:%d (%s)" % (host, port, e))
+
+    def send(self, request):
+        data = request.encode("utf-8")
+        self.sock.sendall(b"%04x" % len(data) + data)
+        self.check_status()
+
+    def check_status(self):
+        status = self.recv_exactly(4)
+        if status == b"OKAY":
+            return
+        if status == b"FAIL":
+            raise AdbError(self.recv_string())
+        raise AdbError("Unexpected adb status %r" % status)
+
+    def recv_exactly(self, size):
+        data = bytearray()
+        while len(data) < size:
+            packet = self.sock.recv(size - len(data))
+            if not packet:
+                raise AdbError("adb server closed connection")
+            data.extend(packet)
+        return bytes(data)
+
+    def recv_string(self):
+        size = int(self.recv_exactly(4), 16)
+        return self.recv_exactly(size).decode("utf-8", "replace")
+
+    def recv_all(self):
+        chunks = []
+        while 1:
+            packet = self.sock.recv(65536)
+            if not packet:
+                return b"".join(chunks)
+            chunks.append(packet)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class SyncConnection:
+    """Connection switched to the sync service of a device, reusable for
+    any number of pushes."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def push(self, local_path, remote_path, mode=0o644):
+        st = os.stat(local_path)
+        spec = ("%s,%d" % (remote_path, mode)).encode("utf-8")
+        sock = self.conn.sock
+        sock.sendall(b"SEND" + struct.pack("<I", len(spec)) + spec)
+        with open(local_path, "rb") as f:
+            while 1:
+                chunk = f.read(SYNC_DATA_MAX)
+                if not chunk:
+                    break
+                sock.sendall(b"DATA" + struct.pack("<I", len(chunk)) + chunk)
+        sock.sendall(b"DONE" + struct.pack("<I", int(st.st_mtime)))
+        status = self.conn.recv_exactly(4)
+        size, = struct.unpack("<I", self.conn.recv_exactly(4))
+        if status == b"FAIL":
+            raise AdbError(self.conn.recv_exactly(size).decode("utf-8", "replace"))
+        if status != b"OKAY":
+            raise AdbError("Unexpected sync status %r" % status)
+
+    def close(self):
+        try:
+            self.conn.sock.sendall(b"QUIT" + struct.pack("<I", 0))
+        except OSError:
+            pass
+        self.conn.close()
+
+
+class AdbClient:
+    """Client for the adb server socket protocol.
+
+    Host services are one request per connection (the server closes the
+    socket after answering); sync sessions are kept in a per-device pool.
+    """
+
+    def __init__(self, host=None, port=None, timeout=5.):
+        self.host = host or settings.ADB_SERVER_HOST
+        self.port = port or settings.ADB_SERVER_PORT
+        self.timeout = timeout
+        self._sync_pool = {}
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        return AdbConnection(self.host, self.port, self.timeout)
+
+    def _transport(self, serial):
+        conn = self._connect()
+        try:
+            conn.send("host:transport:%s" % serial)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    def query(self, request):
+        conn = self._connect()
+        try:
+            conn.send(request)
+            return conn.recv_string()
+        finally:
+            conn.close()
+
+    def version(self):
+        return int(self.query("host:version"), 16)
+
+    def devices(self):
+        return [x.split("\t") for x in self.query("host:devices").splitlines() if x.strip()]
+
+    def connect(self, address):
+        return self.query("host:connect:%s" % address)
+
+    def forward(self, serial, local, remote):
+        conn = self._connect()
+        try:
+            conn.send("host-serial:%s:forward:%s;%s" % (serial, local, remote))
+            # newer servers send a second OKAY once the forward is set up
+            conn.sock.settimeout(0.5)
+            try:
+                conn.check_status()
+            except socket.timeout:
+                pass
+        finally:
+            conn.close()
+        return True
+
+    def shell(self, serial, command):
+        conn = self._transport(serial)
+        try:
+            conn.send("shell:%s" % command)
+            return conn.recv_all().decode("utf-8", "replace")
+        finally:
+            conn.close()
+
+    def _sync(self, serial):
+        conn = self._transport(serial)
+        try:
+            conn.send("sync:")
+        except Exception:
+            conn.close()
+            raise
+        return SyncConnection(conn)
+
+    def push(self, serial, local_path, remote_path, mode=0o644):
+        with self._lock:
+            sync = self._sync_pool.pop(serial, None)
+        if sync is not None:
+            try:
+                sync.push(local_path, remote_path, mode)
+            except (OSError, AdbError):
+                # pooled session went stale, retry on a fresh one
+                sync.close()
+                sync = None
+        if sync is None:
+            sync = self._sync(serial)
+            try:
+                sync.push(local_path, remote_path, mode)
+            except Exception:
+                sync.close()
+                raise
+        with self._lock:
+            old = self._sync_pool.pop(serial, None)
+            self._sync_pool[serial] = sync
+        if old:
+            old.close()
+        return True
+
+    def close(self, serial=None):
+        with self._lock:
+            serials = [serial] if serial else list(self._sync_pool)
+            syncs = [self._sync_pool.pop(x) for x in serials if x in self._sync_pool]
+        for sync in syncs:
+            sync.close()
+
+    def available(self):
+        tm = time.time()
+        try:
+            self.version()
+        except AdbError:
+            return False
+        logger.debug("adb server answered in %.1f ms", (time.time() - tm) * 1000)
+        return True
+
+
+adb_client = AdbClient()
@@ -0,0 +1,141 @@
+import copy
+import time
+import logging
+import threading
+import collections
+from contextlib import contextmanager
+import settings
+from console.client import client, ClientException
+from console.metrics import metrics
+
+
+__all__ = ("analyzer", "Query")
+
+
+logger = logging.getLogger(__name__)
+queries_total = metrics.counter("robobo_analyzer_queries_total", "Template queries by result", ("result",))
+frame_seconds = metrics.histogram("robobo_analyzer_frame_seconds", "Subscribed queries evaluation time per frame")
+
+
+Query = collections.namedtuple("Query", "name region threshold")
+
+
+class Snapshot:
+    """Template query results for one frame."""
+
+    def __init__(self, key, sample):
+        self.key = key
+        self.sample = sample
+        self.time = time.time()
+        self.results = {}
+
+    def get(self, name, region=None, threshold=None):
+        return self.results.get(make_query(name, region, threshold))
+
+
+def make_query(name, region=None, threshold=None):
+    return Query(name, region and tuple(region), threshold or settings.IMAGE_SEARCH_TRHESHOLD)
+
+
+class Analyzer:
+    """Per-frame template query results shared by all callers.
+
+    Every distinct query (template, region, threshold) is matched at most
+    once per frame, whoever asks first. Subscribed queries are evaluated in
+    the background as soon as a new frame arrives, so consumers only read
+    the snapshot.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._subscriptions = {}
+        self._thread = None
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    def _snapshot_for(self, key, sample):
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.sample is not sample:
+                snapshot = self._snapshot = Snapshot(key, sample)
+            return snapshot
+
+    def find(self, key, sample, template, region=None, threshold=None):
+        """Match `template` on the full frame `key`, `region` is
+        (left, top, right, bottom). Returns a Match or None."""
+        query = make_query(template.name, region, threshold)
+        snapshot = self._snapshot_for(key, sample)
+        try:
+            match = snapshot.results[query]
+            queries_total.labels("hit").inc()
+        except KeyError:
+            queries_total.labels("miss").inc()
+            if region is None:
+                match = template.find(sample, threshold=query.threshold)
+            else:
+                left, top, right, bottom = region
+                match = template.find(sample[top:bottom, left:right], threshold=query.threshold)
+                if match:
+                    match.left += left
+                    match.top += top
+            snapshot.results[query] = match
+        # callers are free to modify their match
+        return copy.copy(match) if match else None
+
+    def evaluate(self, key, sample):
+        with self._lock:
+            queries = {q: t for subscription in self._subscriptions.values() for q, t in subscription.items()}
+        with frame_seconds.time():
+            for query, template in queries.items():
+                self.find(key, sample, template, query.region, query.threshold)
+
+    def subscribe(self, owner, templates, region=None, threshold=None):
+        """Evaluate `templates` on every new frame until `unsubscribe(owner)`."""
+        subscription = {make_query(t.name, region, threshold): t for t in templates}
+        with self._lock:
+            self._subscriptions.setdefault(owner, {}).update(subscription)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="analyzer", daemon=True)
+                self._thread.start()
+
+    def unsubscribe(self, owner):
+        with self._lock:
+            self._subscriptions.pop(owner, None)
+
+    @contextmanager
+    def subscribed(self, owner, templates, region=None, threshold=None):
+        self.subscribe(owner, templates, region, threshold)
+        try:
+            yield
+        finally:
+            self.unsubscribe(owner)
+
+    def _run(self):
+        logger.debug("Analyzer started")
+        key = None
+        while 1:
+            with self._lock:
+                if not self._subscriptions:
+                    self._thread = None
+                    break
+            if not client.connected:
+                key = None
+                time.sleep(1)
+                continue
+            try:
+                if client.wait_frame(key, timeout=1, background=True) is None:
+                    continue
+                key, sample = client.get_keyed_sample()
+                self.evaluate(key, sample)
+            except ClientException:
+                continue
+            except Exception:
+                logger.exception("Analyzer failed")
+                time.sleep(1)
+        logger.debug("Analyzer stopped")
+
+
+analyzer = Analyzer()
@@ -1,9 +1,13 @@
 import logging
-import time
+from console import threads
 from console.trace import trace
-from console.utils import wait, find, find_all, click_mouse, get_sample_part, reshaped_sample, resample_loop
+from console.utils import (wait, find, find_all, click_mouse, get_sample_part, reshaped_sample, resample_loop,
+                           subscribed)
 from console.config import config
+from console.metrics import metrics
 from console.navigation import navigation
+from console.client import client
+from console.environ import active_capture, switch_capture
 
 
 __all__ = (
@@ -16,6 +20,8 @@ __all__ = (
 
 
 logger = logging.getLogger(__name__)
+phase_seconds = metrics.histogram("robobo_arena_phase_seconds", "Arena phase durations", ("phase",))
+games_total = metrics.counter("robobo_arena_games_total", "Finished arena games", ("result",))
 config.add_option("arena:max-force", type=int, min_value=0, default=250000)
 config.add_option("arena:type", choices=(10, 15), default=10)
 config.add_option("arena:kind", choices=("food", "ticket"), default="food")
@@ -111,26 +117,34 @@ def start_arena(count=1, kind=None, max_force=None, type=None):
     `count` - how many times to start the game
     """
     num = 1
-    while count > 0:
-        if start_arena_once(num, kind=kind, max_force=max_force, type=type):
-            num += 1
-            count -= 1
+    with active_capture():
+        while count > 0:
+            if start_arena_once(num, kind=kind, max_force=max_force, type=type):
+                num += 1
+                count -= 1
 
 
 def start_arena_once(num, kind=None, max_force=None, type=None):
+    # no-op inside start_arena, the UI runs single games
+    switch_capture(idle=False)
     try:
         assert kind in (None, "food", "ticket")
         logger.info("start arena #%d", num)
         context = {"played": 0}
         while 1:
             try:
-                goto_arena(kind)
-                finished = run_arena(max_force=max_force, type=type, context=context)
+                with phase_seconds.labels("goto").time():
+                    goto_arena(kind)
+                # game state is polled all the time, keep it ready per frame
+                with phase_seconds.labels("game").time(), subscribed("arena", ARENA_STATES):
+                    finished = run_arena(max_force=max_force, type=type, context=context)
                 if finished:
                     break
-            except Exception:
+            except Exception as e:
                 logger.exception("Got unwanted exception, will retry")
-                time.sleep(2)
+                trace.annotate("exception %r" % e)
+                trace.dump("exception")
+                threads.sleep(2)
     finally:
         logger.info("stop arena #%d", num)
     return context["played"]
@@ -151,7 +165,10 @@ def run_arena(max_force, type, *, loop, context):
         type = config.get("arena:type")
     state = get_arena_state(timeout=2)
     if state == "arena/game/active":
-        if choose_enemy_and_attack(max_force, type):
+        # enemy selection is a race, keep every frame
+        with phase_seconds.labels("attack").time(), client.active():
+            attacked = choose_enemy_and_attack(max_force, type)
+        if attacked:
             context["played"] += 1
         # start search and run bu
     elif state == "arena/game/waiting_next":
@@ -162,9 +179,12 @@ def run_arena(max_force, type, *, loop, context):
         _stats["played"] += 1
         if state == "arena/game/victory":
             _stats["win"] += 1
+            games_total.labels("win").inc()
+        else:
+            games_total.labels("defeat").inc()
         loop.click_and_check("arena/game/back", timeout=3)
     elif state == "arena/game/finished":
-        time.sleep(5)
+        threads.sleep(5)
         if loop.click_and_check(["arena/game/close", "arena/game/close2"], timeout=3):
             return True
     else:
@@ -172,15 +192,18 @@ def run_arena(max_force, type, *, loop, context):
     loop.retry(False)
 
 
+ARENA_STATES = (
+    "arena/game/active",
+    "arena/game/finished",
+    "arena/game/waiting_next",
+    "arena/game/waiting_finish",
+    "arena/game/victory",
+    "arena/game/defeat"
+)
+
+
 def get_arena_state(*args, **kwargs):
-    return wait((
-        "arena/game/active",
-        "arena/game/finished",
-        "arena/game/waiting_next",
-        "arena/game/waiting_finish",
-        "arena/game/victory",
-        "arena/game/defeat"
-    ), *args, trace_frame=1, **kwargs)
+    return wait(ARENA_STATES, *args, trace_frame=1, **kwargs)
 
 
 def get_current_stage10(*args, **kwargs):
@@ -373,7 +396,7 @@ def goto_arena(kind=None, *, loop):
     if loc != "arena":
         navigation.goto("arena")
 
-    loc = navigation.get_loc()
+    loc = navigation.get_loc(expected="arena")
     if loc != "arena":
         loop.retry()
 
@@ -0,0 +1,138 @@
+import logging
+import settings
+from console.config import config
+
+
+__all__ = ("get_profile", "set_capture_profile", "set_idle_capture")
+
+
+logger = logging.getLogger(__name__)
+
+
+config.add_option("capture:profile", choices=tuple(settings.CAPTURE_PROFILES), default="full")
+# lower capture rate and bitrate (settings.IDLE_CAPTURE) between arena sessions
+config.add_option("capture:idle-rate", type=bool, default=True)
+
+
+_idle = True
+
+
+class Profile:
+    """scrcpy server capture settings.
+    `crop` is (x, y, width, height) in screen pixels, None for the whole
+    screen, `max_size` limits the larger frame side (0 - no limit).
+    """
+
+    def __init__(self, name, crop=None, max_size=0, bit_rate=settings.SERVER_BIT_RATE,
+                 max_fps=settings.SERVER_MAX_FPS):
+        self.name = name
+        self.crop = tuple(crop) if crop else None
+        # the server rounds it down to a multiple of 8
+        self.max_size = max_size & ~7
+        self.bit_rate = bit_rate
+        self.max_fps = max_fps
+
+    def server_args(self):
+        """maxsize, bitrate, max fps and crop arguments of the server."""
+        if self.crop:
+            x, y, width, height = self.crop
+            crop = f"{width}:{height}:{x}:{y}"
+        else:
+            crop = "-"
+        return [str(self.max_size), str(self.bit_rate), str(self.max_fps), crop]
+
+    def geometry(self, screen_width=settings.SCREEN_WIDTH, screen_height=settings.SCREEN_HEIGHT):
+        return Geometry(self.crop or (0, 0, screen_width, screen_height), self.max_size)
+
+    def __repr__(self):
+        return "<Profile %s>" % self.name
+
+
+class Geometry:
+    """Frame size of a capture and mapping between screen and frame
+    coordinates. Samples, matches and client gestures are in frame
+    coordinates, fixed positions in the bot code are screen coordinates
+    (SCREEN_WIDTH x SCREEN_HEIGHT) and go through to_frame()."""
+
+    def __init__(self, crop, max_size=0):
+        self.crop = crop
+        x, y, width, height = crop
+        # same rounding as the scrcpy server does
+        width &= ~7
+        height &= ~7
+        if max_size and max(width, height) > max_size:
+            if width >= height:
+                width, height = max_size, (height * max_size // width + 4) & ~7
+            else:
+                width, height = (width * max_size // height + 4) & ~7, max_size
+        self.width = width
+        self.height = height
+        self.scale_x = width / crop[2]
+        self.scale_y = height / crop[3]
+
+    @property
+    def shape(self):
+        return self.height, self.width
+
+    @property
+    def scale(self):
+        """Frame pixels per screen pixel, templates are resized by it."""
+        return self.scale_x, self.scale_y
+
+    def to_frame_size(self, width, height):
+        return max(int(width * self.scale_x), 1), max(int(height * self.scale_y), 1)
+
+    def to_frame_rect(self, x, y, width, height):
+        """Screen rectangle as (x, y, width, height) in the frame, clipped."""
+        left, top = self.to_frame(x, y)
+        right, bottom = self.to_frame(x + width, y + height)
+        left, top = max(left, 0), max(top, 0)
+        right, bottom = min(right, self.width), min(bottom, self.height)
+        return left, top, max(right - left, 0), max(bottom - top, 0)
+
+    def to_frame(self, x, y):
+        return int((x - self.crop[0]) * self.scale_x), int((y - self.crop[1]) * self.scale_y)
+
+    def in_frame(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def clamp(self, x, y):
+        return min(max(x, 0), self.width - 1), min(max(y, 0), self.height - 1)
+
+
+def get_profile(name=None):
+    """The named profile, or the current one with the idle rate applied."""
+    if name:
+        return Profile(name, **settings.CAPTURE_PROFILES[name])
+    name = config.get("capture:profile")
+    kwargs = dict(settings.CAPTURE_PROFILES[name])
+    if _idle and config.get("capture:idle-rate"):
+        kwargs.update(settings.IDLE_CAPTURE)
+    return Profile(name, **kwargs)
+
+
+def set_idle(idle):
+    """Switch between the idle and the active capture rate, returns True if
+    the server arguments changed (the server must be restarted)."""
+    global _idle
+    before = get_profile().server_args()
+    _idle = idle
+    return get_profile().server_args() != before
+
+
+def set_idle_capture(value):
+    """Use a lower capture rate between arena sessions, from the next reboot.
+
+    Examples:
+        set_idle_capture(False)
+    """
+    config.set("capture:idle-rate", value)
+
+
+def set_capture_profile(name):
+    """Select the capture profile, used from the next reboot.
+
+    Examples:
+        set_capture_profile("full")
+    """
+    config.set("capture:profile", name)
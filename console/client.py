@@ -3,10 +3,17 @@ import socket
 import random
 import logging
 import struct
+import threading
+from contextlib import contextmanager
 import numpy as np
 import settings
 from console.config import config
 from console.exceptions import ConsoleException
+from console.interrupts import Interrupts
+from console.metrics import metrics
+from console.probes import bringup
+from console.decoder import StreamDecoder, use_inprocess
+from console.capture import get_profile
 from console import threads
 
 
@@ -20,6 +27,18 @@ __all__ = (
 logger = logging.getLogger(__name__)
 
 
+frames_received = metrics.counter(
+    "robobo_frames_received_total", "Frames received from the stream, materialized or skipped")
+last_frame_time = metrics.gauge("robobo_last_frame_timestamp_seconds", "Time the last frame was received")
+frames_dropped = metrics.counter(
+    "robobo_frames_dropped_total", "Frames materialized for a waiter but replaced before anyone sampled them")
+frames_skipped = metrics.counter(
+    "robobo_frames_skipped_total", "Frames dropped in the receiver because nobody was waiting for them")
+frame_age_seconds = metrics.histogram(
+    "robobo_frame_age_seconds", "Age of a frame when it is first sampled")
+gestures_sent = metrics.counter("robobo_gestures_sent_total", "Gestures sent to the device", ("kind",))
+
+
 class ClientException(ConsoleException):
     logger = "client"
 
@@ -62,7 +81,9 @@ def to_fixed_point_16(f):
     return max(int(f * 0x10000), 0xffff)
 
 
-def pack_mouse_event(action, buttons, x, y):
+def pack_mouse_event(action, buttons, x, y, width=settings.SCREEN_WIDTH, height=settings.SCREEN_HEIGHT):
+    # the server maps (x, y) from the frame size back to the screen, taking
+    # crop and scale into account, events with a stale frame size are dropped
     return struct.pack(
         ">BBqLLHHHL",
         Inject.TOUCH_EVENT,      # 8
@@ -70,8 +91,8 @@ def pack_mouse_event(action, buttons, x, y):
         -1,                      # 64 pointer_id = -1
         x,                       # 32
         y,                       # 32
-        settings.SCREEN_WIDTH,   # 16
-        settings.SCREEN_HEIGHT,  # 16
+        width,                   # 16
+        height,                  # 16
         0xffff,                  # 16 pressure == 1.0
         buttons                  # 32
     )
@@ -80,60 +101,130 @@ def pack_mouse_event(action, buttons, x, y):
 class Client:
     server_port = settings.SERVER_PORT
     receiver_port = settings.RECEIVER_PORT
-    _sample = None
-    _sample_key = None
+    last_frame_time = 0
+    _keyed_sample = (None, None)
     _control_socket = None
     _receiver_socket = None
+    # accepted scrshare connection, kept to wake the receiver on close
+    _video_conn = None
     _videobuff = None
     _connected = False
-
-    def connect(self, timeout=3.):
+    _control_closed = None
+    # optional console.framepool.FrameRing, frames are published to it as they arrive
+    frame_ring = None
+    # foreground wait_frame calls and active() blocks, frames are only
+    # materialized when somebody needs them
+    _demand = 0
+    _active = 0
+    _stale = False
+    # the current buffer was materialized for a waiter, not as an idle refresh
+    _demanded = False
+    # every frame off the stream, skipped ones included (UI frame rate)
+    received_count = 0
+    # frame size and screen mapping of the capture profile, set on connect
+    geometry = get_profile("full").geometry()
+
+    def __init__(self, server_port=None, receiver_port=None):
+        # per device: a handler on one device must not hold up the others
+        self.interrupts = Interrupts()
+        self._gesture_lock = threading.RLock()
+        if server_port:
+            self.server_port = server_port
+        if receiver_port:
+            self.receiver_port = receiver_port
+
+    def connect(self, timeout=settings.CLIENT_READY_TIMEOUT, steps=bringup):
         if self._connected:
             raise ClientConnectedException("Already connected")
         self._thead_container = threads.ThreadContainer()
-        self._sample = None
-        self._sample_key = None
+        self.geometry = get_profile().geometry()
+        self._keyed_sample = (None, None)
+        self._videobuff = None
+        self._demanded = False
+        self.received_count = 0
+        self._frame_cond = threading.Condition()
         self._receiver_socket = socket.socket()
-        self._thead_container.run(self.video_receiver)
+        decoder = None
+        if use_inprocess():
+            # same order as the scrcpy client: video socket and its marker
+            # byte, control socket, then the device info on the video socket
+            with steps.step("video"):
+                decoder = self._connect_stream(timeout)
+        else:
+            self._thead_container.run(self.video_receiver)
         self._control_socket = socket.socket()
-        self._control_socket.connect(("127.0.0.1", self.server_port))
+        with steps.step("control"):
+            self._control_socket.settimeout(timeout)
+            try:
+                self._control_socket.connect(("127.0.0.1", self.server_port))
+            except OSError as e:
+                self._control_socket.close()
+                self._receiver_socket.close()
+                self._thead_container.close()
+                raise ClientNotConnectedException("Control socket is not accepted (%s)" % e)
+            self._control_socket.settimeout(None)
+        if decoder is not None:
+            with steps.step("device info"):
+                try:
+                    decoder.read_device_info()
+                except (OSError, ConsoleException) as e:
+                    self._control_socket.close()
+                    self._receiver_socket.close()
+                    self._thead_container.close()
+                    raise ClientNotConnectedException("No device info on the video stream (%s)" % getattr(e, "msg", e))
+            self._receiver_socket.settimeout(None)
+            self._thead_container.run(self.stream_receiver, (decoder,))
+        self._control_closed = threading.Event()
         self._thead_container.run(self.control_receiver)
-        time.sleep(timeout)
         self._connected = True
         try:
+            with steps.step("first frame"):
+                self._wait_first_frame(timeout)
             self._check_sample_size()
         except ClientException:
             self.close()
             raise
         return True
 
+    def _wait_first_frame(self, timeout):
+        # connecting to an adb forwarded port always succeeds, adb closes the
+        # socket if nothing listens on the device. The server streams only
+        # after it has accepted the control socket, so the first frame is
+        # the real handshake.
+        deadline = time.monotonic() + timeout
+        while self.wait_frame(None, 0.1) is None:
+            if self._control_closed.is_set():
+                raise ClientNotConnectedException("Control socket closed by the device")
+            if time.monotonic() >= deadline:
+                raise ClientNotConnectedException("No frames received in %.1fs" % timeout)
+
     @property
     def connected(self):
         return self._connected
 
     def _check_sample_size(self):
         sample = self.new_sample()
-        if sample.shape != (settings.SCREEN_HEIGHT, settings.SCREEN_WIDTH):
+        if sample.shape != self.geometry.shape:
             self.close()
             raise ClientInvalidScreenSize("Expected screen size: (%d, %d), got: (%d, %d)" % (
-                settings.SCREEN_WIDTH,
-                settings.SCREEN_HEIGHT,
+                self.geometry.width,
+                self.geometry.height,
                 sample.shape[1],
                 sample.shape[0]
             ))
 
     def close(self):
         if self._connected:
+            # shutdown wakes up the receivers blocked in accept/recv
+            for sock in (self._control_socket, self._receiver_socket, self._video_conn):
+                if sock is None:
+                    continue
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
             self._thead_container.close()
             self._thead_container = None
-            try:
-                self._control_socket.shutdown(socket.SHUT_RDWR)
-            except OSError:
-                pass
-            try:
-                self._receiver_socket.shutdown(socket.SHUT_RDWR)
-            except OSError:
-                pass
             self._control_socket.close()
             self._receiver_socket.close()
             self._control_socket = None
@@ -143,12 +234,85 @@ class Client:
     def __del__(self):
         self.close()
 
+    def _connect_stream(self, timeout):
+        self._receiver_socket.settimeout(timeout)
+        try:
+            self._receiver_socket.connect(("127.0.0.1", self.server_port))
+            decoder = StreamDecoder(self._receiver_socket)
+            decoder.read_marker()
+        except (OSError, ConsoleException) as e:
+            self._receiver_socket.close()
+            self._thead_container.close()
+            raise ClientNotConnectedException("Video stream is not accepted (%s)" % getattr(e, "msg", e))
+        return decoder
+
+    def _frame_wanted(self):
+        if self._demand or self._active:
+            return True
+        # keep an idle buffer reasonably fresh for background consumers
+        return time.time() - self.last_frame_time >= config.get("client:idle-frame-interval")
+
+    def _skip_frame(self):
+        self._stale = True
+        self.received_count += 1
+        frames_received.inc()
+        frames_skipped.inc()
+
+    @contextmanager
+    def active(self):
+        """Materialize every frame, even when nobody is waiting for it."""
+        with self._frame_cond:
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._frame_cond:
+                self._active -= 1
+
+    def _push_frame(self, key, width, height, data):
+        ring = self.frame_ring
+        if ring is not None and ring.shape == (height, width):
+            ring.publish(key, data)
+        prev = self._videobuff
+        if self._demanded and prev is not None and prev[0] != self._keyed_sample[0]:
+            # a waiter wanted it, but the matching did not keep up
+            frames_dropped.inc()
+        self._demanded = bool(self._demand or self._active)
+        self._videobuff = (key, width, height, data)
+        self._stale = False
+        self.last_frame_time = time.time()
+        self.received_count += 1
+        frames_received.inc()
+        last_frame_time.set(self.last_frame_time)
+        with self._frame_cond:
+            self._frame_cond.notify_all()
+
+    def stream_receiver(self, decoder):
+        logger.info("Stream decoder started.")
+        key = 0
+        try:
+            for frame in decoder.frames(self._frame_wanted):
+                if frame is None:
+                    self._skip_frame()
+                    continue
+                key += 1
+                height, width = frame.shape
+                self._push_frame(key, width, height, frame)
+        except OSError:
+            pass
+        logger.info("Stream decoder stopped.")
+
     def video_receiver(self):
         logger.info("Video receiver started.")
         self._receiver_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._receiver_socket.bind(("127.0.0.1", self.receiver_port))
         self._receiver_socket.listen()
-        conn, addr = self._receiver_socket.accept()
+        try:
+            conn, addr = self._receiver_socket.accept()
+        except OSError:
+            logger.info("Video receiver stopped.")
+            return
+        self._video_conn = conn
 
         def recvall(sock, n):
             # Helper function to recv n bytes or return None if EOF is hit
@@ -160,98 +324,196 @@ class Client:
                 data.extend(packet)
             return data
 
+        scratch = memoryview(bytearray(65536))
+
+        def skip(sock, n):
+            while n > 0:
+                count = sock.recv_into(scratch, min(n, len(scratch)))
+                if not count:
+                    return False
+                n -= count
+            return True
+
         with conn:
             logger.info("Video receiver connected to %s", addr)
             key = 0
-            while True:
-                frame_info = recvall(conn, 12)
-                if not frame_info:
-                    break
-                size, width, height = np.frombuffer(frame_info, dtype=np.uint32)
-                data = recvall(conn, size.item())
-                if not data:
-                    break
-                key += 1
-                self._videobuff = (key, width.item(), height.item(), data)
+            try:
+                while True:
+                    frame_info = recvall(conn, 12)
+                    if not frame_info:
+                        break
+                    size, width, height = np.frombuffer(frame_info, dtype=np.uint32)
+                    if not self._frame_wanted():
+                        # nobody is waiting, don't even allocate the frame
+                        if not skip(conn, size.item()):
+                            break
+                        self._skip_frame()
+                        continue
+                    data = recvall(conn, size.item())
+                    if not data:
+                        break
+                    key += 1
+                    self._push_frame(key, width.item(), height.item(), data)
+            except OSError:
+                pass
+            finally:
+                self._video_conn = None
 
         logger.info("Video receiver stopped.")
 
     def control_receiver(self):
         device_msg_serialized_max_size = 4096
         logger.info("Control receiver started.")
-        while 1:
-            data = self._control_socket.recv(device_msg_serialized_max_size)
-            if not data:
-                break
+        try:
+            while 1:
+                data = self._control_socket.recv(device_msg_serialized_max_size)
+                if not data:
+                    break
+        finally:
+            self._control_closed.set()
         logger.info("Control receiver stopped.")
 
     def ensure_connected(self):
         if not self._connected:
             raise ClientNotConnectedException("Not connected")
 
+    @property
+    def sample_key(self):
+        return self._keyed_sample[0]
+
+    def wait_frame(self, key=None, timeout=None, background=False):
+        """Block until a frame newer than `key` is received, return its key
+        (or None on timeout).
+        Background waiters (watchdog, analyzer) don't make the receiver keep
+        every frame, they get one per "client:idle-frame-interval" when idle.
+        """
+        self.ensure_connected()
+        token = threads.current_token()
+
+        def newer():
+            buf = self._videobuff
+            return buf is not None and buf[0] != key
+
+        token.add_waker(self._wake_frame_waiters)
+        try:
+            with self._frame_cond:
+                if not background:
+                    self._demand += 1
+                try:
+                    ready = self._frame_cond.wait_for(lambda: newer() or token.cancelled, timeout)
+                finally:
+                    if not background:
+                        self._demand -= 1
+        finally:
+            token.remove_waker(self._wake_frame_waiters)
+        token.check()
+        if not ready:
+            return None
+        return self._videobuff[0]
+
+    def _wake_frame_waiters(self):
+        with self._frame_cond:
+            self._frame_cond.notify_all()
+
     @property
     def videobuf(self):
         if self._connected:
             return self._videobuff
 
-    def get_sample(self):
+    def get_keyed_sample(self):
         self.ensure_connected()
+        if self._stale:
+            # frames were skipped since this one, wait for a fresh one
+            self.wait_frame(self._videobuff[0], config.get("client:idle-frame-interval"))
         key, width, height, data = self._videobuff
         # key, width, height = np.frombuffer(video.read(12), dtype=np.uint32)
-        if (height, width) != (settings.SCREEN_HEIGHT, settings.SCREEN_WIDTH):
+        if (height, width) != self.geometry.shape:
             logger.error("Invalid frame size.")
-        elif key != self._sample_key:
+        elif key != self._keyed_sample[0]:
+            frame_age_seconds.observe(time.time() - last_frame_time.value)
             sample = np.frombuffer(data, dtype=np.uint8)
             sample = sample.reshape((height, width))
-            self._sample = sample
-            self._sample_key = key
-        return self._sample
+            # the watchdog thread samples too, keep key and sample consistent
+            self._keyed_sample = (key, sample)
+        return self._keyed_sample
+
+    def get_sample(self):
+        return self.get_keyed_sample()[1]
 
     def new_sample(self):
-        cur_key = self._sample_key
+        cur_key = self.sample_key
         sample = self.get_sample()
-        while cur_key == self._sample_key:
-            time.sleep(settings.SCRSHARE_RENDER_INTERVAL / 1000.)
+        interval = settings.SCRSHARE_RENDER_INTERVAL / 1000.
+        while cur_key == self.sample_key:
+            arrived = self.wait_frame(cur_key, interval) is not None
             sample = self.get_sample()
+            if arrived and cur_key == self.sample_key:
+                # a frame arrived but could not be sampled, don't spin
+                threads.sleep(interval)
         return sample
 
+    def _send_mouse_event(self, action, x, y):
+        geometry = self.geometry
+        self._control_socket.send(pack_mouse_event(
+            action, MouseButton.PRIMARY, x, y, geometry.width, geometry.height))
+
     def mouse_down(self, x, y):
-        self._control_socket.send(pack_mouse_event(MouseAcion.DOWN, MouseButton.PRIMARY, x, y))
+        self._send_mouse_event(MouseAcion.DOWN, x, y)
 
     def mouse_up(self, x, y):
-        self._control_socket.send(pack_mouse_event(MouseAcion.UP, MouseButton.PRIMARY, x, y))
+        self._send_mouse_event(MouseAcion.UP, x, y)
 
     def mouse_move(self, x, y):
-        self._control_socket.send(pack_mouse_event(MouseAcion.MOVE, MouseButton.PRIMARY, x, y))
+        self._send_mouse_event(MouseAcion.MOVE, x, y)
 
     def click(self, x, y, rand_x=None, rand_y=None):
         if rand_x:
             x += random.randint(-rand_x, rand_x)
         if rand_y:
             y += random.randint(-rand_y, rand_y)
-        self.mouse_down(x, y)
-        time.sleep(config.get("client:click-timeout"))
-        self.mouse_up(x, y)
+        # the jitter must not leave the frame
+        x, y = self.geometry.clamp(x, y)
+        if self.interrupts.preempt():
+            logger.info("click at (%d, %d) dropped, the screen changed during an interrupt", x, y)
+            return None
+        # gestures of the bot and the watchdog must not interleave
+        with self._gesture_lock:
+            self.mouse_down(x, y)
+            try:
+                threads.sleep(config.get("client:click-timeout"))
+            finally:
+                # never leave the pointer down, even when cancelled
+                self.mouse_up(x, y)
+        gestures_sent.labels("click").inc()
         return x, y
 
     def move(self, x1, y1, x2, y2):
         c = 8
         dx = (x2 - x1) / c
         dy = (y2 - y1) / c
-        self.mouse_down(x1, y1)
-        time.sleep(0.05)
-        move_timeout = config.get("client:move-timeout")
-        for n in range(c):
-            self.mouse_move(int(x1 + dx * n), int(y1 + dy * n))
-            time.sleep(move_timeout)
-        time.sleep(0.05)
-        self.mouse_up(x2, y2)
+        if self.interrupts.preempt():
+            logger.info("swipe dropped, the screen changed during an interrupt")
+            return
+        with self._gesture_lock:
+            self.mouse_down(x1, y1)
+            try:
+                threads.sleep(0.05)
+                move_timeout = config.get("client:move-timeout")
+                for n in range(c):
+                    self.mouse_move(int(x1 + dx * n), int(y1 + dy * n))
+                    threads.sleep(move_timeout)
+                threads.sleep(0.05)
+            finally:
+                self.mouse_up(x2, y2)
+        gestures_sent.labels("move").inc()
 
 
 client = Client()
 
 config.add_option("client:click-timeout", type=float, min_value=0.001, max_value=1., default=0.15)
 config.add_option("client:move-timeout", type=float, min_value=0.001, max_value=1., default=0.02)
+# frame rate of background waiters (the watchdog) while the bot is idle
+config.add_option("client:idle-frame-interval", type=float, min_value=0., max_value=10., default=0.25)
 
 
 def set_client_click_timeout(value):
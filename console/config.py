@@ -1,7 +1,20 @@
+import os
 import json
+import time
+import atexit
+import logging
+import threading
+from types import MappingProxyType
 import settings
 
 
+logger = logging.getLogger(__name__)
+
+
+# seconds without changes before the config is written
+FLUSH_DELAY = 1.
+
+
 class Option:
     def __init__(self, type=None, min_value=None, max_value=None, choices=None, default=None):
         self.type = type
@@ -25,35 +38,93 @@ class Option:
 class Config:
     def __init__(self, filename):
         self.filename = filename
-        self._data = {}
+        # read-only snapshot, replaced as a whole on every change
+        self._data = MappingProxyType({})
         self._options = {}
+        self._cond = threading.Condition()
+        # the flusher and the atexit flush share the .tmp file
+        self._dump_lock = threading.Lock()
+        self._dirty_since = None
+        self._flusher = None
         self._load()
 
     def add_option(self, name, **kwargs):
         self._options[name] = Option(**kwargs)
 
-    def get(self, name):
-        default = self._options[name].default if name in self._options else None
-        return self._data.get(name, default)
+    def get(self, name, default=None):
+        option = self._options.get(name)
+        return self._data.get(name, option.default if option else default)
 
     def set(self, name, value):
         if name in self._options:
             value = self._options[name].validate(value)
         else:
             raise KeyError("Unknown option")
-        self._data[name] = value
-        self._dump()
+        with self._cond:
+            if self._data.get(name, ...) == value:
+                return
+            data = dict(self._data)
+            data[name] = value
+            self._data = MappingProxyType(data)
+            self._dirty_since = time.monotonic()
+            self._start_flusher()
+            self._cond.notify()
+
+    def flush(self):
+        with self._dump_lock:
+            # taken under the dump lock, an older snapshot never overwrites a newer one
+            with self._cond:
+                data = self._data if self._dirty_since is not None else None
+                self._dirty_since = None
+            if data is not None:
+                try:
+                    self._dump(data)
+                except Exception:
+                    # retried after FLUSH_DELAY by the flusher, or by the atexit flush
+                    with self._cond:
+                        if self._dirty_since is None:
+                            self._dirty_since = time.monotonic()
+                            self._cond.notify()
+                    raise
+
+    def _start_flusher(self):
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+            atexit.register(self.flush)
+
+    def _flush_loop(self):
+        while 1:
+            with self._cond:
+                self._cond.wait_for(lambda: self._dirty_since is not None)
+                # debounce: wait until the changes settle down
+                delay = self._dirty_since + FLUSH_DELAY - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Could not save config")
 
     def _load(self):
         try:
             with open(self.filename, "r") as f:
-                self._data = json.loads(f.read())
+                self._data = MappingProxyType(json.loads(f.read()))
+        except FileNotFoundError:
+            self._data = MappingProxyType({})
         except Exception:
-            self._data = {}
+            logger.exception("Could not load config %r", self.filename)
+            self._data = MappingProxyType({})
 
-    def _dump(self):
-        with open(self.filename, "w") as f:
-            f.write(json.dumps(self._data))
+    def _dump(self, data):
+        # write-then-rename, a crash never leaves a truncated config
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "w") as f:
+            f.write(json.dumps(dict(data)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.filename)
 
 
 config = Config(settings.CONFIG_FILE)
@@ -0,0 +1,171 @@
+import os
+import time
+import struct
+import logging
+import settings
+from console.config import config
+from console.exceptions import ConsoleException
+from console.metrics import metrics
+
+try:
+    import av
+except ImportError:
+    av = None
+
+
+__all__ = ("benchmark_decoders",)
+
+
+logger = logging.getLogger(__name__)
+decode_seconds = metrics.histogram("robobo_decode_seconds", "In-process H.264 decode and gray conversion time per frame")
+
+
+# "scrshare" - frames come from the external scrshare process,
+# "inprocess" - the client decodes the scrcpy stream itself (needs PyAV)
+config.add_option("stream:decoder", choices=("scrshare", "inprocess"), default=settings.STREAM_DECODER)
+
+
+DEVICE_NAME_FIELD_LENGTH = 64
+FRAME_META = struct.Struct(">QI")
+
+
+class DecoderException(ConsoleException):
+    logger = "decoder"
+
+
+def use_inprocess():
+    return config.get("stream:decoder") == "inprocess"
+
+
+def recvall(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        packet = sock.recv(n - len(data))
+        if not packet:
+            return None
+        data.extend(packet)
+    return data
+
+
+class StreamDecoder:
+    """Decodes the scrcpy video socket into gray frames.
+
+    The server is started with frame meta, every packet is preceded by
+    its pts and size, so there is no need to look for NAL boundaries.
+    """
+
+    def __init__(self, sock):
+        if av is None:
+            raise DecoderException("In-process decoding needs PyAV (pip install av)")
+        self.sock = sock
+        self.codec = av.CodecContext.create("h264", "r")
+        self.device_name = None
+        self.width = self.height = None
+
+    def read_marker(self):
+        # forward tunnel: the server sends one byte right after accept
+        if not recvall(self.sock, 1):
+            raise DecoderException("Video socket closed before the stream started")
+
+    def read_device_info(self):
+        # only sent once the server has accepted the control socket too
+        meta = recvall(self.sock, DEVICE_NAME_FIELD_LENGTH + 4)
+        if not meta:
+            raise DecoderException("Video socket closed before device info")
+        self.device_name = meta[:DEVICE_NAME_FIELD_LENGTH].split(b"\0", 1)[0].decode("utf-8", "replace")
+        self.width, self.height = struct.unpack(">HH", meta[DEVICE_NAME_FIELD_LENGTH:])
+        logger.info("Video stream of %s (%dx%d)", self.device_name, self.width, self.height)
+
+    def frames(self, wanted=None):
+        """Yield gray frames as (height, width) uint8 arrays until EOF.
+        Frames are still decoded when `wanted()` is false, but not converted,
+        None is yielded instead.
+        """
+        while 1:
+            header = recvall(self.sock, FRAME_META.size)
+            if not header:
+                return
+            _, size = FRAME_META.unpack(header)
+            data = recvall(self.sock, size)
+            if not data:
+                return
+            tm = time.perf_counter()
+            # config packets (SPS/PPS) are merged into the next frame by the parser
+            for packet in self.codec.parse(bytes(data)):
+                for frame in self.codec.decode(packet):
+                    if wanted is not None and not wanted():
+                        yield None
+                        continue
+                    gray = frame.to_ndarray(format="gray")
+                    decode_seconds.observe(time.perf_counter() - tm)
+                    yield gray
+                    tm = time.perf_counter()
+
+
+def process_cpu_time(pid):
+    with open("/proc/%d/stat" % pid) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    # utime and stime, fields 14 and 15
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def measure_stream(duration=10.):
+    """Frame rate, host CPU and decode time of the running stream."""
+    from console import adb
+    from console.client import client, frame_age_seconds
+    scrshare = adb.default_server.scrshare_proc
+    decode_before = decode_seconds.snapshot()
+    age_before = frame_age_seconds.snapshot()
+    key = client.sample_key
+    cpu = time.process_time()
+    helper_cpu = process_cpu_time(scrshare.pid) if scrshare else 0.
+    tm = time.time()
+    frames = 0
+    while time.time() - tm < duration:
+        new_key = client.wait_frame(key, timeout=1)
+        if new_key is not None:
+            frames += 1
+            key, _ = client.get_keyed_sample()
+    elapsed = time.time() - tm
+    cpu = time.process_time() - cpu
+    if scrshare:
+        cpu += process_cpu_time(scrshare.pid) - helper_cpu
+    decoded, decode_sum, _ = decode_seconds.snapshot()
+    sampled, age_sum, _ = frame_age_seconds.snapshot()
+    decoded -= decode_before[0]
+    sampled -= age_before[0]
+    return {
+        "decoder": config.get("stream:decoder"),
+        "fps": frames / elapsed,
+        "cpu_percent": 100. * cpu / elapsed,
+        "decode_ms": 1000. * (decode_sum - decode_before[1]) / decoded if decoded else None,
+        "frame_age_ms": 1000. * (age_sum - age_before[1]) / sampled if sampled else None,
+    }
+
+
+def benchmark_decoders(duration=10.):
+    """Compare scrshare and in-process decoding on the current device.
+    The device is rebooted for every decoder, the option is restored after.
+
+    Examples:
+        benchmark_decoders()
+        benchmark_decoders(30)
+    """
+    from console.environ import reboot
+    current = config.get("stream:decoder")
+    results = []
+    try:
+        for decoder in ("scrshare", "inprocess"):
+            config.set("stream:decoder", decoder)
+            try:
+                reboot()
+                results.append(measure_stream(duration))
+            except ConsoleException as e:
+                logger.error("%s: %s", decoder, e.msg)
+    finally:
+        config.set("stream:decoder", current)
+        reboot()
+    for item in results:
+        logger.info("%(decoder)s: %(fps).1f fps, cpu %(cpu_percent).1f%%, decode %(decode_ms)s ms, "
+                    "frame age %(frame_age_ms)s ms", item)
+    return results
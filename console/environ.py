@@ -1,21 +1,92 @@
-import time
+import logging
+from contextlib import contextmanager
+import settings
 from console import adb
+from console import threads
+from console.capture import set_idle
 from console.client import client, ClientException
+from console.probes import bringup
+from console.exceptions import ConsoleException
+from console.supervisor import supervisor, DevicePipeline
 from console.watchdog import start_watchdog
 
 
-__all__ = ("reboot",)
+__all__ = ("reboot", "supervise", "supervisor_status")
+
+
+logger = logging.getLogger(__name__)
 
 
 def reboot():
+    if supervisor.owns(client):
+        raise ConsoleException("The device is supervised, it is restarted automatically")
     client.close()
-    if not adb.run_server():
+    bringup.reset()
+    try:
+        if not adb.run_server():
+            return
+        if adb.processes_started():
+            try:
+                client.connect()
+            except ClientException:
+                adb.kill_server()
+                raise
+            start_watchdog()
+    finally:
+        bringup.report()
+
+
+@contextmanager
+def active_capture():
+    """Full capture rate inside, the idle rate after ("capture:idle-rate").
+    The server takes the rate only at start, so switching reboots the
+    device and is done at session boundaries only."""
+    switch_capture(idle=False)
+    try:
+        yield
+    finally:
+        if not threads.current_token().cancelled:
+            try:
+                switch_capture(idle=True)
+            except ConsoleException as e:
+                logging.getLogger(e.logger or "console").error(e.msg)
+
+
+def switch_capture(idle):
+    if not set_idle(idle) or not client.connected:
         return
-    time.sleep(1)
-    if adb.processes_started():
-        try:
-            client.connect()
-        except ClientException:
-            adb.kill_server()
-            raise
-        start_watchdog()
+    if supervisor.owns(client):
+        # picked up by the next pipeline restart
+        return
+    logger.info("switching to the %s capture rate", "idle" if idle else "active")
+    reboot()
+
+
+def supervise(*devices):
+    """Keep devices running, failed ones are restarted automatically.
+    Without arguments the default device (the bot's client) is supervised,
+    other devices get their own ports and clients, that needs the in-process
+    decoder or port placeholders in settings.SCRSHARE_ARGS.
+    While the default device is supervised, reboot() is refused.
+
+    Examples:
+        supervise()
+        supervise("127.0.0.1:62001", "127.0.0.1:62025")
+    """
+    if not devices:
+        supervisor.add(DevicePipeline(server=adb.default_server, client=client, on_start=start_watchdog))
+    for num, serial in enumerate(devices):
+        if serial == adb.default_server.serial:
+            supervisor.add(DevicePipeline(server=adb.default_server, client=client, on_start=start_watchdog))
+        else:
+            supervisor.add(DevicePipeline(
+                serial,
+                server_port=settings.SERVER_PORT + 2 * (num + 1),
+                receiver_port=settings.RECEIVER_PORT + 2 * (num + 1)
+            ))
+    supervisor.start()
+
+
+def supervisor_status():
+    for item in supervisor.status():
+        logger.info("%(device)s: %(state)s, uptime %(uptime).0fs, restarts %(restarts)d, last error %(last_error)s", item)
@@ -0,0 +1,202 @@
+import time
+import heapq
+import queue
+import logging
+import threading
+import collections
+from concurrent.futures import Future
+from console import threads
+from console.exceptions import ConsoleException
+
+
+__all__ = ("Executor", "JobRejected")
+
+
+logger = logging.getLogger(__name__)
+
+
+class JobRejected(ConsoleException):
+    logger = "executor"
+
+
+class Job:
+    def __init__(self, lane, name, fn, args=(), kwargs=None):
+        self.lane = lane
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.future = Future()
+        self.token = threads.CancelToken()
+        self.status = "queued"
+        self.started_at = None
+        self.finished_at = None
+
+    def cancel(self):
+        """Drop the job if it is queued, ask it to stop if it is running."""
+        self.token.cancel()
+        if self.future.cancel():
+            self.status = "cancelled"
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def add_done_callback(self, fn):
+        self.future.add_done_callback(lambda future: fn(self))
+
+    @property
+    def done(self):
+        return self.future.done()
+
+    def __repr__(self):
+        return "<Job %s/%s %s>" % (self.lane, self.name, self.status)
+
+
+class Lane:
+    """One worker thread running jobs one at a time, with a bounded queue
+    and optional periodic tasks."""
+
+    def __init__(self, name, max_pending):
+        self.name = name
+        self.current = None
+        self._queue = queue.Queue(max_pending)
+        self._names = set()
+        self._periodic = []
+        self._counter = 0
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="lane-" + name, daemon=True)
+        self._thread.start()
+
+    def submit(self, job):
+        with self._lock:
+            if self._closed:
+                raise JobRejected("Lane %r is closed" % self.name)
+            if job.name in self._names:
+                raise JobRejected("Job %r is already queued or running" % job.name)
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                raise JobRejected("Lane %r is busy" % self.name)
+            self._names.add(job.name)
+        return job
+
+    def schedule(self, name, fn, interval):
+        with self._lock:
+            self._counter += 1
+            heapq.heappush(self._periodic, (time.monotonic(), self._counter, interval, name, fn))
+        # wake up the worker to recompute its timeout
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            current = self.current
+        if current:
+            current.cancel()
+        while 1:
+            try:
+                job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if job:
+                job.cancel()
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            # refilled meanwhile, the worker wakes up for those items anyway
+            pass
+
+    def _next_periodic(self):
+        with self._lock:
+            if not self._periodic:
+                return None, None
+            when, _, interval, name, fn = self._periodic[0]
+            delay = when - time.monotonic()
+            if delay > 0:
+                return None, delay
+            # after a slow run skip the missed ticks instead of catching up
+            next_run = max(when + interval, time.monotonic())
+            heapq.heapreplace(self._periodic, (next_run, self._counter, interval, name, fn))
+            self._counter += 1
+            return fn, 0
+
+    def _run(self):
+        while not self._closed:
+            fn, delay = self._next_periodic()
+            if fn:
+                try:
+                    fn()
+                except Exception:
+                    logger.exception("periodic task failed in lane %r", self.name)
+                continue
+            try:
+                job = self._queue.get(timeout=delay)
+            except queue.Empty:
+                continue
+            if job is None:
+                continue
+            if self._closed:
+                job.cancel()
+                continue
+            self._execute(job)
+
+    def _execute(self, job):
+        try:
+            if not job.future.set_running_or_notify_cancel():
+                return
+            self.current = job
+            job.status = "running"
+            job.started_at = time.time()
+            with threads.token_context(job.token):
+                try:
+                    result = job.fn(*job.args, **job.kwargs)
+                except threads.Cancelled as e:
+                    job.status = "cancelled"
+                    job.future.set_exception(e)
+                except BaseException as e:
+                    job.status = "failed"
+                    logger.exception("job %r failed", job.name)
+                    job.future.set_exception(e)
+                else:
+                    job.status = "cancelled" if job.token.cancelled else "done"
+                    job.future.set_result(result)
+        finally:
+            job.finished_at = time.time()
+            self.current = None
+            with self._lock:
+                self._names.discard(job.name)
+
+
+class Executor:
+    """Named serialized lanes for jobs started from the UI.
+
+    Jobs of a lane run one after another on the lane's only thread, a job
+    name can be queued once at a time and a full lane rejects new jobs.
+    """
+
+    def __init__(self, lanes):
+        self._lanes = {name: Lane(name, max_pending) for name, max_pending in lanes.items()}
+        self._history = collections.deque(maxlen=50)
+
+    def submit(self, lane, name, fn, *args, **kwargs):
+        job = Job(lane, name, fn, args, kwargs)
+        self._lanes[lane].submit(job)
+        self._history.append(job)
+        return job
+
+    def schedule(self, lane, name, fn, interval):
+        self._lanes[lane].schedule(name, fn, interval)
+
+    def current(self, lane):
+        return self._lanes[lane].current
+
+    def jobs(self):
+        return list(self._history)
+
+    def close(self):
+        for lane in self._lanes.values():
+            lane.close()
@@ -0,0 +1,104 @@
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from console.config import config
+from console.metrics import metrics
+
+
+__all__ = ("start_exporter", "stop_exporter")
+
+
+logger = logging.getLogger(__name__)
+
+
+config.add_option("exporter:port", type=int, min_value=0, max_value=65535, default=0)
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, escape(value)) for name, value in pairs)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_metrics():
+    """Render all metrics in the Prometheus text exposition format."""
+    lines = []
+    for family in metrics.families():
+        lines.append("# HELP %s %s" % (family.name, family.help))
+        lines.append("# TYPE %s %s" % (family.name, family.type))
+        for values, child in family.children():
+            if family.type != "histogram":
+                lines.append("%s%s %s" % (
+                    family.name, format_labels(family.labelnames, values), format_value(child.value)))
+                continue
+            count, total, counts = child.snapshot()
+            cumulative = 0
+            for le, bucket in zip(child.buckets + (float("inf"),), counts):
+                cumulative += bucket
+                lines.append("%s_bucket%s %d" % (
+                    family.name,
+                    format_labels(family.labelnames, values, [("le", format_value(le))]),
+                    cumulative
+                ))
+            labels = format_labels(family.labelnames, values)
+            lines.append("%s_sum%s %s" % (family.name, labels, format_value(total)))
+            lines.append("%s_count%s %d" % (family.name, labels, count))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+
+
+def start_exporter(port=None):
+    """Serve metrics on http://127.0.0.1:`port`/metrics.
+    `port` defaults to the "exporter:port" option, 0 disables the exporter.
+    """
+    global _server
+    if _server:
+        return _server.server_address[1]
+    port = config.get("exporter:port") if port is None else port
+    if not port:
+        return None
+    _server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
+    logger.info("Metrics exporter listening on 127.0.0.1:%d", _server.server_address[1])
+    return _server.server_address[1]
+
+
+def stop_exporter():
+    global _server
+    if _server:
+        server, _server = _server, None
+        server.shutdown()
+        server.server_close()
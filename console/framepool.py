@@ -0,0 +1,133 @@
+import time
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import settings
+from console import threads
+
+
+__all__ = ("FrameRing", "MatchPool")
+
+
+logger = logging.getLogger(__name__)
+
+
+# a stuck or killed worker never answers, its query is given up after this
+RESULT_TIMEOUT = 5.
+# result polls keep the waiting thread cancellable
+POLL_INTERVAL = 0.1
+
+
+class FrameRing:
+    """Ring of the latest frames in shared memory.
+
+    Slot `key % slots` holds frame `key`. The slot key is set to -1 while
+    the frame is being written, readers compare it before and after use to
+    detect frames overwritten under them.
+    """
+
+    def __init__(self, slots=8, height=settings.SCREEN_HEIGHT, width=settings.SCREEN_WIDTH, name=None):
+        self.slots = slots
+        self.shape = (height, width)
+        size = 8 * slots + slots * height * width
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.keys = np.ndarray((slots,), dtype=np.int64, buffer=self.shm.buf)
+        self.frames = np.ndarray((slots, height, width), dtype=np.uint8, buffer=self.shm.buf, offset=8 * slots)
+        if self.owner:
+            self.keys[:] = -1
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def spec(self):
+        return self.slots, self.shape[0], self.shape[1], self.name
+
+    def publish(self, key, data):
+        slot = key % self.slots
+        self.keys[slot] = -1
+        self.frames[slot].reshape(-1)[:] = np.frombuffer(data, dtype=np.uint8)
+        self.keys[slot] = key
+
+    def get(self, key):
+        """Zero-copy view of frame `key`, None if it is not in the ring."""
+        slot = key % self.slots
+        if self.keys[slot] != key:
+            return None
+        return self.frames[slot]
+
+    def valid(self, key):
+        return self.keys[key % self.slots] == key
+
+    def close(self):
+        self.keys = self.frames = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+_ring = None
+
+
+def _worker_init(spec, geometry):
+    global _ring
+    from console.client import client
+    # templates are scaled to the parent's capture profile
+    client.geometry = geometry
+    slots, height, width, name = spec
+    _ring = FrameRing(slots, height, width, name=name)
+
+
+def _worker_find(key, name, threshold):
+    from console.utils import templates
+    sample = _ring.get(key)
+    if sample is None:
+        return key, name, False, None
+    match = templates[name].find(sample, threshold=threshold)
+    if not _ring.valid(key):
+        return key, name, False, None
+    if match:
+        return key, name, True, (match.left, match.top, match.width, match.height)
+    return key, name, True, None
+
+
+class MatchPool:
+    """Worker processes running template queries against a FrameRing."""
+
+    def __init__(self, ring, geometry, processes=None):
+        self.ring = ring
+        context = multiprocessing.get_context("spawn")
+        self._pool = context.Pool(processes, initializer=_worker_init, initargs=(ring.spec(), geometry))
+
+    def find_all_targets(self, key, targets, threshold=None):
+        """Match every target on frame `key` in parallel.
+        Returns {name: (left, top, width, height) or None}, or None if the
+        frame left the ring before all results were ready, or a worker did
+        not answer in RESULT_TIMEOUT.
+        """
+        pending = [self._pool.apply_async(_worker_find, (key, name, threshold)) for name in targets]
+        deadline = time.monotonic() + RESULT_TIMEOUT
+        results = {}
+        for res in pending:
+            while 1:
+                threads.check_cancelled()
+                try:
+                    res_key, name, valid, box = res.get(POLL_INTERVAL)
+                    break
+                except multiprocessing.TimeoutError:
+                    if time.monotonic() >= deadline:
+                        logger.warning("match pool did not answer in %.1fs", RESULT_TIMEOUT)
+                        return None
+            if not valid or res_key != key:
+                return None
+            results[name] = box
+        return results
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
@@ -0,0 +1,87 @@
+"""Import time report for the console startup.
+
+    python -m console.importtime [--budget MS] [--top N] [modules...]
+
+Runs a fresh interpreter with `-X importtime` and prints the slowest imports
+(cumulative). Only the imports the prompt waits for are budgeted, the exit
+code is 1 if they exceed it. The modules console.startup loads in background
+are reported separately, after the synchronous ones. Modules given on the
+command line are budgeted as a whole.
+"""
+import sys
+import argparse
+import subprocess
+import settings
+from console.startup import _LAZY_MODULES
+
+
+# imported by console.startup before the prompt shows up
+STARTUP_MODULES = (
+    "settings",
+    "console",
+    "console.logging",
+    "console.exceptions",
+)
+# imported by console.startup in a background thread
+BACKGROUND_MODULES = tuple(spec.partition(":")[0] for spec in _LAZY_MODULES)
+MARKER = "--- measured ---"
+
+
+def measure(modules, preload=()):
+    """Import time entries of `modules`, imported after `preload`."""
+    code = "; ".join(["import %s" % x for x in preload] + [
+        "import sys",
+        "sys.stderr.write(%r)" % (MARKER + "\n"),
+        "sys.stderr.flush()",
+    ] + ["import %s" % x for x in modules])
+    complete = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        encoding="utf-8"
+    )
+    if complete.returncode != 0:
+        raise RuntimeError(complete.stderr.strip().splitlines()[-1])
+    lines = complete.stderr.splitlines()
+    entries = []
+    for line in lines[lines.index(MARKER) + 1:]:
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        entries.append((int(self_us), int(cumulative_us), name.rstrip()))
+    return entries
+
+
+def report(entries, top=15, out=sys.stdout):
+    # top level imports start right after the "|", nested ones are indented
+    total = sum(cumulative for _, cumulative, name in entries if not name.startswith("  "))
+    out.write("%10s %10s  %s\n" % ("self ms", "cumul ms", "module"))
+    for self_us, cumulative_us, name in sorted(entries, key=lambda x: -x[1])[:top]:
+        out.write("%10.1f %10.1f %s\n" % (self_us / 1000, cumulative_us / 1000, name))
+    out.write("total %.1f ms\n" % (total / 1000))
+    return total / 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m console.importtime")
+    parser.add_argument("modules", nargs="*")
+    parser.add_argument("--budget", type=float, default=settings.STARTUP_IMPORT_BUDGET, help="ms")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args(argv)
+    if args.modules:
+        total = report(measure(args.modules), top=args.top)
+    else:
+        print("startup (before the prompt):")
+        total = report(measure(STARTUP_MODULES), top=args.top)
+        print()
+        print("background (not budgeted):")
+        report(measure(BACKGROUND_MODULES, preload=STARTUP_MODULES), top=args.top)
+    if total > args.budget:
+        print("over budget: %.1f ms > %.1f ms" % (total, args.budget))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
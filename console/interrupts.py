@@ -0,0 +1,91 @@
+import logging
+import threading
+from contextlib import contextmanager
+from console import threads
+
+
+__all__ = ("Interrupts", "Interrupted")
+
+
+logger = logging.getLogger(__name__)
+
+
+class Interrupted(Exception):
+    """Bot input was preempted by an interrupt, the current sample is stale."""
+
+
+class Interrupts:
+    """Interrupts between the watchdog and the bot thread of one client.
+
+    While an interrupt is active, every other thread blocks at its next
+    checkpoint (before a wait iteration or a gesture). Interrupts are served
+    one at a time.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._active = None
+        self._pending = 0
+        self._local = threading.local()
+
+    @property
+    def active(self):
+        active = self._active
+        return active[0] if active else None
+
+    def owns(self):
+        active = self._active
+        return active is not None and active[1] == threading.get_ident()
+
+    @contextmanager
+    def interrupt(self, name):
+        entry = (name, threading.get_ident())
+        with self._cond:
+            self._pending += 1
+            self._cond.wait_for(lambda: self._active is None)
+            self._pending -= 1
+            self._active = entry
+        logger.info("interrupt %r", name)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active = None
+                self._cond.notify_all()
+            logger.info("resume after %r", name)
+
+    def checkpoint(self):
+        """Block while someone else's interrupt is active or pending.
+        Returns True if the caller was blocked.
+        """
+        if self._active is None and not self._pending or self.owns():
+            return False
+        token = threads.current_token()
+        with self._cond:
+            blocked = False
+            while self._active is not None or self._pending:
+                blocked = True
+                token.check()
+                # timed wait keeps the thread stoppable
+                self._cond.wait(0.1)
+        return blocked
+
+    def preempt(self):
+        """Checkpoint before bot input, raises Interrupted inside resample_loop.
+        Returns True if the caller was blocked outside of it, the input is
+        stale then and must be dropped.
+        """
+        if not self.checkpoint():
+            return False
+        if getattr(self._local, "depth", 0):
+            raise Interrupted()
+        return True
+
+    @contextmanager
+    def loop(self):
+        self._local.depth = getattr(self._local, "depth", 0) + 1
+        try:
+            yield
+        finally:
+            self._local.depth -= 1
+
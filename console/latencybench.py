@@ -0,0 +1,227 @@
+"""Frame-to-click latency benchmark.
+
+    python -m console.latencybench [--fps 10 30 60] [--templates 1 5 20] [--trials 30] [-o results.json]
+
+Replaces the device with a fake scrshare stream and a fake control server,
+runs `wait(...).click()` in the client and measures the time from the first
+frame showing the target to the touch down event on the control socket.
+The target is the last of the waited templates, the others never match.
+"""
+import sys
+import json
+import time
+import queue
+import socket
+import struct
+import argparse
+import threading
+import numpy as np
+from console import threads
+from console.client import client, MouseAcion
+from console.decoder import use_inprocess
+from console.capture import get_profile
+from console.matchbench import list_templates
+from console import utils
+
+
+# pack_mouse_event() message
+TOUCH_EVENT = struct.Struct(">BBqLLHHHL")
+TARGET_POSITION = (600, 300)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class FakeControl(threading.Thread):
+    """Control server, queues the arrival time of every touch down."""
+
+    def __init__(self, port):
+        super().__init__(daemon=True)
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", port))
+        self.sock.listen()
+        self.clicks = queue.Queue()
+
+    def run(self):
+        try:
+            conn, _ = self.sock.accept()
+        except OSError:
+            return
+        with conn:
+            data = b""
+            while 1:
+                packet = conn.recv(4096)
+                if not packet:
+                    break
+                tm = time.perf_counter()
+                data += packet
+                while len(data) >= TOUCH_EVENT.size:
+                    event = TOUCH_EVENT.unpack(data[:TOUCH_EVENT.size])
+                    data = data[TOUCH_EVENT.size:]
+                    if event[1] == MouseAcion.DOWN:
+                        self.clicks.put(tm)
+
+    def close(self):
+        self.sock.close()
+
+
+class FakeStream(threading.Thread):
+    """scrshare stand-in, sends the current frame `fps` times a second."""
+
+    def __init__(self, port, fps, frame):
+        super().__init__(daemon=True)
+        self.port = port
+        self.interval = 1. / fps
+        self.frame = frame
+        self.shown = None
+        self._pending = None
+        self._closed = threading.Event()
+
+    def show(self, frame):
+        """Switch the frame, `shown` is set when it is first sent."""
+        self.shown = None
+        self._pending = frame
+
+    def run(self):
+        height, width = self.frame.shape
+        header = struct.pack("=III", width * height, width, height)
+        for _ in range(50):
+            try:
+                sock = socket.create_connection(("127.0.0.1", self.port))
+                break
+            except OSError:
+                time.sleep(0.1)
+        else:
+            return
+        with sock:
+            deadline = time.perf_counter()
+            while not self._closed.is_set():
+                pending, self._pending = self._pending, None
+                if pending is not None:
+                    self.frame = pending
+                    self.shown = time.perf_counter()
+                try:
+                    sock.sendall(header + self.frame.tobytes())
+                except OSError:
+                    break
+                deadline += self.interval
+                delay = deadline - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+    def close(self):
+        self._closed.set()
+
+
+def make_frames(target):
+    rnd = np.random.default_rng(0)
+    background = rnd.integers(0, 256, get_profile().geometry().shape, dtype=np.uint8)
+    frame = background.copy()
+    img = utils.templates[target].img
+    x, y = TARGET_POSITION
+    frame[y:y + img.shape[0], x:x + img.shape[1]] = img
+    return background, frame
+
+
+def bot(targets, stop):
+    target = targets[-1]
+    while not stop.is_set():
+        match = utils.wait(targets, timeout=None, can_trace=False)
+        match.click()
+        utils.wait_while(target, timeout=None, can_trace=False)
+
+
+def run(fps, targets, trials=30, timeout=5.):
+    """Latencies (seconds) of `trials` frame-to-click runs."""
+    client.server_port, client.receiver_port = free_port(), free_port()
+    background, frame = make_frames(targets[-1])
+    control = FakeControl(client.server_port)
+    control.start()
+    stream = FakeStream(client.receiver_port, fps, background)
+    container = threads.ThreadContainer()
+    stop = threading.Event()
+    latencies = []
+    try:
+        stream.start()
+        client.connect()
+        container.run(bot, (targets, stop))
+        for _ in range(trials):
+            # random phase between the stream and the bot
+            time.sleep(0.2 + np.random.random() / fps)
+            stream.show(frame)
+            try:
+                clicked = control.clicks.get(timeout=timeout)
+            except queue.Empty:
+                clicked = None
+            shown = stream.shown
+            stream.show(background)
+            if clicked is not None and shown is not None and clicked >= shown:
+                latencies.append(clicked - shown)
+    finally:
+        stop.set()
+        container.close()
+        client.close()
+        stream.close()
+        control.close()
+    return latencies
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def summary(latencies):
+    if not latencies:
+        return {"count": 0}
+    ms = [x * 1000 for x in latencies]
+    return {
+        "count": len(ms),
+        "min_ms": min(ms),
+        "p50_ms": percentile(ms, 50),
+        "p90_ms": percentile(ms, 90),
+        "p99_ms": percentile(ms, 99),
+        "max_ms": max(ms),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m console.latencybench")
+    parser.add_argument("--fps", type=int, nargs="+", default=(10, 30, 60))
+    parser.add_argument("--templates", type=int, nargs="+", default=(1, 5, 20), help="waited templates")
+    parser.add_argument("--trials", type=int, default=30)
+    parser.add_argument("--target", help="template to click, the first one by default")
+    parser.add_argument("-o", "--output", help="write results to a JSON file")
+    args = parser.parse_args(argv)
+    if use_inprocess():
+        print("the benchmark fakes scrshare, set stream:decoder to \"scrshare\"")
+        return 1
+
+    names = list_templates()
+    target = args.target or names[0]
+    decoys = [x for x in names if x != target]
+    results = []
+    print("%5s %9s %6s %8s %8s %8s %8s %8s" % ("fps", "templates", "count", "min", "p50", "p90", "p99", "max"))
+    for fps in args.fps:
+        for count in args.templates:
+            targets = decoys[:count - 1] + [target]
+            item = dict(fps=fps, templates=len(targets), **summary(run(fps, targets, args.trials)))
+            results.append(item)
+            if item["count"]:
+                print("%5d %9d %6d %8.1f %8.1f %8.1f %8.1f %8.1f" % (
+                    fps, len(targets), item["count"], item["min_ms"], item["p50_ms"],
+                    item["p90_ms"], item["p99_ms"], item["max_ms"]))
+            else:
+                print("%5d %9d      no clicks" % (fps, len(targets)))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,247 @@
+"""Template matching micro-benchmarks.
+
+    python -m console.matchbench [--samples DIR] [--only PREFIX] [-o results.json]
+    python -m console.matchbench --baseline bench/matchbench.json
+
+Runs every template in the template directory against the stored samples
+(`save_sample()` output), reports ns per call, throughput, allocations and
+match results. With a baseline, slowdowns over the tolerance and changed
+match results are reported and the exit code is 1.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+from datetime import datetime
+import cv2
+import numpy as np
+import settings
+from console.utils import templates, find
+
+
+# expected matches, {"sample.png": ["template/name", ...]}
+EXPECTED_FILE = "expected.json"
+
+
+def list_templates(directory=settings.TEMPLATE_DIR, only=None):
+    names = []
+    for root, _, files in os.walk(directory):
+        for filename in files:
+            name, ext = os.path.splitext(os.path.relpath(os.path.join(root, filename), directory))
+            # top level images are not templates (the app icon)
+            if ext == ".png" and os.sep in name:
+                name = name.replace(os.sep, "/")
+                if only is None or name.startswith(only):
+                    names.append(name)
+    return sorted(names)
+
+
+def load_samples(directory=settings.SAMPLE_DIR):
+    samples = {}
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith(".png"):
+            img = cv2.imread(os.path.join(directory, filename))
+            samples[filename] = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    expected = {}
+    expected_file = os.path.join(directory, EXPECTED_FILE)
+    if os.path.exists(expected_file):
+        with open(expected_file) as f:
+            expected = json.load(f)
+    return samples, expected
+
+
+def measure(fn, min_time=0.2, repeat=5):
+    """Best time per call (ns) of `repeat` rounds, about `min_time` seconds
+    in total."""
+    number = 1
+    while 1:
+        tm = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - tm
+        if elapsed >= min_time / repeat or number >= 1 << 20:
+            break
+        number *= 2
+    best = elapsed
+    for _ in range(repeat - 1):
+        tm = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, time.perf_counter() - tm)
+    return best * 1e9 / number
+
+
+def allocations(fn):
+    """Allocated blocks and peak traced memory (bytes) of one call."""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        fn()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    blocks = sum(max(stat.count_diff, 0) for stat in after.compare_to(before, "lineno"))
+    # the peak is measured separately, tracing restarts with a zero peak
+    # (tracemalloc.reset_peak() is python 3.9+)
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return blocks, peak
+
+
+def run_case(fn, min_time):
+    ns = measure(fn, min_time)
+    blocks, peak = allocations(fn)
+    return {
+        "ns_per_call": ns,
+        "calls_per_sec": 1e9 / ns if ns else None,
+        "alloc_blocks": blocks,
+        "alloc_peak_bytes": peak,
+    }
+
+
+def box(match):
+    return [int(match.left), int(match.top)] if match else None
+
+
+def run(names, samples, min_time=0.2):
+    cases = {}
+    frames = list(samples.items())
+    for name in names:
+        template = templates[name]
+
+        def find_samples():
+            return [template.find(sample) for _, sample in frames]
+
+        case = run_case(find_samples, min_time)
+        case["ns_per_call"] /= len(frames)
+        case["calls_per_sec"] *= len(frames)
+        case["results"] = {filename: box(template.find(sample)) for filename, sample in frames}
+        cases["find:" + name] = case
+
+        def find_all_samples():
+            return [template.find_all(sample) for _, sample in frames]
+
+        case = run_case(find_all_samples, min_time)
+        case["ns_per_call"] /= len(frames)
+        case["calls_per_sec"] *= len(frames)
+        case["results"] = {filename: sorted(box(x) for x in template.find_all(sample)) for filename, sample in frames}
+        cases["find_all:" + name] = case
+
+        # candidates as find_all sees them, most templates have none
+        candidates = []
+        for _, sample in frames:
+            res = template.match_template(sample)
+            loc = np.where(res >= settings.IMAGE_SEARCH_TRHESHOLD)
+            candidates.append(list(zip(*loc[::-1])))
+        if any(candidates):
+            cases["without_intersections:" + name] = run_case(
+                lambda: [template.without_intersections(x) for x in candidates], min_time)
+
+    # a wait() iteration: the first of several targets on one frame
+    groups = {}
+    for name in names:
+        groups.setdefault(name.rsplit("/", 1)[0], []).append(name)
+    for group, targets in sorted(groups.items()):
+        if len(targets) < 2:
+            continue
+
+        def find_targets():
+            return [find(targets, sample=sample, can_trace=False) for _, sample in frames]
+
+        case = run_case(find_targets, min_time)
+        case["ns_per_call"] /= len(frames)
+        case["calls_per_sec"] *= len(frames)
+        case["targets"] = len(targets)
+        results = {}
+        for filename, sample in frames:
+            match = find(targets, sample=sample, can_trace=False)
+            results[filename] = match.name if match else None
+        case["results"] = results
+        cases["find_targets:" + group] = case
+    return cases
+
+
+def check_expected(cases, expected):
+    missed = []
+    for filename, names in expected.items():
+        for name in names:
+            case = cases.get("find:" + name)
+            if case is not None and case["results"].get(filename) is None:
+                missed.append("%s not found on %s" % (name, filename))
+    return missed
+
+
+def compare(cases, baseline, tolerance):
+    regressions = []
+    mismatches = []
+    for key, case in cases.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if case["ns_per_call"] > base["ns_per_call"] * (1 + tolerance):
+            regressions.append("%s: %.0f ns -> %.0f ns (%+.0f%%)" % (
+                key, base["ns_per_call"], case["ns_per_call"],
+                100. * (case["ns_per_call"] / base["ns_per_call"] - 1)))
+        if "results" in base and case.get("results") != base["results"]:
+            mismatches.append("%s: results differ from the baseline" % key)
+    return regressions, mismatches
+
+
+def report(cases, out=sys.stdout):
+    out.write("%12s %12s %8s %12s  %s\n" % ("ns/call", "calls/s", "blocks", "peak bytes", "case"))
+    for key, case in sorted(cases.items(), key=lambda x: -x[1]["ns_per_call"]):
+        out.write("%12.0f %12.1f %8d %12d  %s\n" % (
+            case["ns_per_call"], case["calls_per_sec"], case["alloc_blocks"], case["alloc_peak_bytes"], key))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m console.matchbench")
+    parser.add_argument("--samples", default=settings.SAMPLE_DIR)
+    parser.add_argument("--only", help="template name prefix, e.g. arena/game")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per case")
+    parser.add_argument("-o", "--output", help="write results to a JSON file")
+    parser.add_argument("--baseline", help="compare with a previous JSON output")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown, 0.2 = 20%%")
+    args = parser.parse_args(argv)
+
+    samples, expected = load_samples(args.samples)
+    if not samples:
+        print("no samples in %s, use save_sample() to collect some" % args.samples)
+        return 1
+    names = list_templates(only=args.only)
+    cases = run(names, samples, args.min_time)
+    report(cases)
+
+    result = {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "machine": platform.machine(),
+        "samples": sorted(samples),
+        "cases": cases,
+    }
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=1, sort_keys=True)
+
+    failed = check_expected(cases, expected)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions, mismatches = compare(cases, baseline["cases"], args.tolerance)
+        failed += regressions + mismatches
+    for line in failed:
+        print(line)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
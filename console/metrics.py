@@ -0,0 +1,124 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+
+__all__ = ("metrics", )
+
+
+DEFAULT_BUCKETS = (
+    .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60., 300.
+)
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Gauge:
+    type = "gauge"
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        tm = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - tm)
+
+    def snapshot(self):
+        with self._lock:
+            return self.count, self.sum, list(self.counts)
+
+
+class Family:
+    """Metric with label values, `labels(...)` returns the child metric."""
+
+    def __init__(self, cls, name, help, labelnames, **kwargs):
+        self.cls = cls
+        self.type = cls.type
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._kwargs = kwargs
+        self._children = {}
+        self._lock = threading.Lock()
+        if not labelnames:
+            self._children[()] = cls(**kwargs)
+
+    def labels(self, *values):
+        try:
+            return self._children[values]
+        except KeyError:
+            with self._lock:
+                return self._children.setdefault(values, self.cls(**self._kwargs))
+
+    def children(self):
+        return list(self._children.items())
+
+    def __getattr__(self, name):
+        # unlabeled families proxy their single metric
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._children[()], name)
+
+
+class Metrics:
+    def __init__(self):
+        self._families = {}
+
+    def _add(self, cls, name, help, labels, **kwargs):
+        if name not in self._families:
+            self._families[name] = Family(cls, name, help, tuple(labels), **kwargs)
+        return self._families[name]
+
+    def counter(self, name, help="", labels=()):
+        return self._add(Counter, name, help, labels)
+
+    def gauge(self, name, help="", labels=()):
+        return self._add(Gauge, name, help, labels)
+
+    def histogram(self, name, help="", labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram, name, help, labels, buckets=buckets)
+
+    def get(self, name):
+        return self._families[name]
+
+    def families(self):
+        return list(self._families.values())
+
+
+metrics = Metrics()
@@ -1,7 +1,11 @@
 import time
+import heapq
 import logging
 import settings
-from console.utils import resample_loop, wait, click, mouse_move
+from console.client import client
+from console import threads
+from console.trace import trace
+from console.utils import resample_loop, wait, find, click, mouse_move
 
 
 __all__ = ("navigation", )
@@ -10,18 +14,62 @@ __all__ = ("navigation", )
 logger = logging.getLogger(__name__)
 
 
+class Transition:
+
+    # weight of the last measured duration in the running cost estimate
+    smoothing = 0.3
+
+    def __init__(self, from_loc, to_loc, action, cost=1.):
+        self.from_loc = from_loc
+        self.to_loc = to_loc
+        self.action = action
+        self.cost = cost
+
+    def measure(self, duration):
+        self.cost += (duration - self.cost) * self.smoothing
+
+    def __repr__(self):
+        return "%r -> %r (%.2fs)" % (self.from_loc, self.to_loc, self.cost)
+
+
 class Navigation:
 
     def __init__(self):
         self._transitions = {}
         self._location_check = {}
         self._check_to_location = {}
-
-    def get_loc(self, timeout=0):
-        check = wait(self._check_to_location.keys(), timeout=timeout, trace_frame=1)
-        if not check:
-            return None
-        return self._check_to_location[check]
+        self._routes = {}
+        self._last_loc = None
+        self._cache = (None, None)
+
+    def get_loc(self, timeout=0, expected=None):
+        sample_key = client.get_keyed_sample()[0]
+        key, loc = self._cache
+        # a miss on this frame says nothing about the next ones, so with a
+        # timeout only a found location is reused
+        if key is not None and key == sample_key and (loc is not None or not timeout):
+            return loc
+        loc = None
+        if expected is not None:
+            if find(self._location_check[expected], trace_frame=1):
+                loc = expected
+        if loc is None:
+            check = wait(self._ordered_checks(), timeout=timeout, trace_frame=1)
+            if check:
+                loc = self._check_to_location[check]
+        self._remember(loc)
+        return loc
+
+    def _ordered_checks(self):
+        # the last known location is the most likely one, check it first
+        checks = list(self._location_check.get(self._last_loc, ()))
+        checks.extend(x for x in self._check_to_location if x not in checks)
+        return checks
+
+    def _remember(self, loc):
+        self._cache = (client.sample_key, loc)
+        if loc is not None:
+            self._last_loc = loc
 
     @resample_loop(logger=logger)
     def goto(self, loc, *, loop):
@@ -31,19 +79,34 @@ class Navigation:
                 "don't know how to get from unknown location to %r", loc,
                 extra={"rate": 1}
             )
+            trace.dump("unknown location")
             return False
         logger.info("location %r", curloc)
         if loc == curloc:
             return True
-        transition = self.get_transition(curloc, loc)
-        if not transition:
+        route = self.get_route(curloc, loc)
+        if not route:
             logger.error(
                 "don't know how to get from %r to %r", curloc, loc,
                 extra={"rate": 1}
             )
             return False
-        transition()
-        loop.retry()
+        for transition in route:
+            if not self._run_transition(transition):
+                loop.retry()
+        return True
+
+    def _run_transition(self, transition):
+        logger.info("go to %r", transition.to_loc)
+        tm = time.time()
+        if not transition.action():
+            return False
+        if not wait(self._location_check[transition.to_loc], trace_frame=2, dump_on_timeout=True):
+            return False
+        self._remember(transition.to_loc)
+        transition.measure(time.time() - tm)
+        self._build_routes()
+        return True
 
     def add_location(self, loc, check):
         # assert loc not in self._location_check and check not in self._check_to_location
@@ -51,33 +114,47 @@ class Navigation:
         self._location_check.setdefault(loc, []).append(check)
         self._check_to_location[check] = loc
 
-    def add_transition(self, from_loc, to_loc):
+    def add_transition(self, from_loc, to_loc, cost=1.):
         assert from_loc in self._location_check and to_loc in self._location_check
 
         def wrapper(action):
-            def transition():
-                logger.info("go to %r", to_loc)
-                if action():
-                    wait(self._location_check[to_loc], trace_frame=1)
-            self._transitions[(from_loc, to_loc)] = transition
-            return transition
+            self._transitions[(from_loc, to_loc)] = Transition(from_loc, to_loc, action, cost)
+            self._build_routes()
+            return action
         return wrapper
 
     def get_transition(self, from_loc, to_loc):
-        return self._transitions.get((from_loc, to_loc))
+        route = self.get_route(from_loc, to_loc)
+        if route:
+            return route[0]
+
+    def get_route(self, from_loc, to_loc):
+        return self._routes.get((from_loc, to_loc))
+
+    def _build_routes(self):
+        edges = {}
+        for (from_loc, to_loc), transition in self._transitions.items():
+            edges.setdefault(from_loc, []).append(transition)
+        routes = {}
+        for start in self._location_check:
+            # dijkstra from every location, the graph is tiny
+            costs = {start: 0.}
+            queue = [(0., start, ())]
+            while queue:
+                cost, loc, route = heapq.heappop(queue)
+                if cost > costs[loc]:
+                    continue
+                if route:
+                    routes[(start, loc)] = list(route)
+                for transition in edges.get(loc, ()):
+                    new_cost = cost + transition.cost
+                    if new_cost < costs.get(transition.to_loc, float("inf")):
+                        costs[transition.to_loc] = new_cost
+                        heapq.heappush(queue, (new_cost, transition.to_loc, route + (transition,)))
+        self._routes = routes
 
     def setup(self):
-        found = 1
-        while found:
-            found = 0
-            paths = list(self._transitions.keys())
-            for k in paths:
-                for v in paths:
-                    if k[0] == v[1] or (k[0], v[1]) in self._transitions:
-                        continue
-                    elif k[1] == v[0]:
-                        found += 1
-                        self._transitions[(k[0], v[1])] = self._transitions[k]
+        self._build_routes()
 
 
 navigation = Navigation()
@@ -101,10 +178,10 @@ def map_to_home_transition():
     return click("map/home", logger=logger)
 
 
-@navigation.add_transition("map", "arena")
+@navigation.add_transition("map", "arena", cost=2.)
 def map_to_arena_transition():
     mouse_move(50, 50, settings.SCREEN_WIDTH - 50, 50)
-    time.sleep(0.5)
+    threads.sleep(0.5)
     return click("map/arena", logger=logger)
 
 
@@ -0,0 +1,60 @@
+import time
+import logging
+from contextlib import contextmanager
+from console.exceptions import ConsoleException
+from console.metrics import metrics
+
+
+__all__ = ("ProbeTimeout", "wait_until", "bringup")
+
+
+logger = logging.getLogger(__name__)
+
+
+step_seconds = metrics.histogram("robobo_bringup_step_seconds", "Device bring-up step durations", ("step",))
+
+
+class ProbeTimeout(ConsoleException):
+    logger = "probes"
+
+
+def wait_until(check, timeout, name, interval=0.05):
+    """Poll `check` until it returns a true value, give up after `timeout`
+    seconds with ProbeTimeout."""
+    deadline = time.monotonic() + timeout
+    while 1:
+        result = check()
+        if result:
+            return result
+        if time.monotonic() >= deadline:
+            raise ProbeTimeout("%s is not ready after %.1fs" % (name, timeout))
+        time.sleep(interval)
+
+
+class BringUp:
+    """Durations of the bring-up steps of the last reboot."""
+
+    def __init__(self):
+        self.steps = []
+
+    def reset(self):
+        self.steps = []
+
+    @contextmanager
+    def step(self, name):
+        tm = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - tm
+            self.steps.append((name, duration))
+            step_seconds.labels(name).observe(duration)
+
+    def report(self):
+        if self.steps:
+            logger.info("bring-up: %s, total %.0f ms", ", ".join(
+                "%s %.0f ms" % (name, duration * 1000) for name, duration in self.steps
+            ), sum(duration for _, duration in self.steps) * 1000)
+
+
+bringup = BringUp()
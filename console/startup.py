@@ -1,45 +1,91 @@
 import os
 import sys
 import logging
-import cv2
+import threading
 import time
 from datetime import datetime
 import settings
 from console import __version__
 
 
-print("Robot v%s" % __version__)
-print()
-
 from console.logging import setup_logging
-setup_logging()
-del setup_logging
-
 from console.exceptions import ConsoleException
-from console.client import client
-from console.config import *
-from console.environ import *
-from console.utils import *
-from console.navigation import *
-from console.arena import *
-from console.watchdog import *
-from console.trace import trace
+
+
+# heavy modules (cv2, numpy, the arena and navigation graph) are imported
+# in background, their names show up here as soon as they are loaded
+_LAZY_MODULES = (
+    "cv2",
+    "console.client:client",
+    "console.config",
+    "console.environ",
+    "console.utils",
+    "console.navigation",
+    "console.arena",
+    "console.watchdog",
+    "console.trace:trace",
+    "console.exporter:start_exporter,stop_exporter",
+    "console.decoder:benchmark_decoders",
+    "console.capture",
+)
+_loaded = threading.Event()
+
+
+def _import_lazy_modules(namespace):
+    import importlib
+    for spec in _LAZY_MODULES:
+        module_name, _, names = spec.partition(":")
+        module = importlib.import_module(module_name)
+        if module_name == "cv2":
+            namespace["cv2"] = module
+            continue
+        if names:
+            names = names.split(",")
+        else:
+            names = getattr(module, "__all__", None) or [x for x in dir(module) if not x.startswith("_")]
+        namespace.update((name, getattr(module, name)) for name in names)
+
+
+def _background_startup(namespace):
+    tm = time.time()
+    try:
+        _import_lazy_modules(namespace)
+    finally:
+        _loaded.set()
+    logger = logging.getLogger("console")
+    logger.info("modules loaded in %.0f ms", (time.time() - tm) * 1000)
+    try:
+        namespace["start_exporter"]()
+        namespace["reboot"]()
+    except ConsoleException as e:
+        logging.getLogger(e.logger or "console").error(e.msg)
+    except Exception:
+        logger.exception("reboot failed")
+
+
+def ready(timeout=None):
+    """Wait until background startup has loaded all modules."""
+    return _loaded.wait(timeout)
 
 
 def _exception_hook(exctype, value, traceback):
     if isinstance(value, ConsoleException):
+        from console.config import config
         if value.logger and not config.get("traceback", False):
             logging.getLogger(value.logger).error(value.msg)
         else:
             logging.getLogger("console").error(value.msg)
+    elif isinstance(value, NameError) and not _loaded.is_set():
+        logging.getLogger("console").error("%s (still loading, try again in a moment)", value)
     else:
         sys.__excepthook__(exctype, value, traceback)
 
 
-sys.excepthook = _exception_hook
 
 
 def save_sample(filename=None, *, sample=None, directory=settings.SAMPLE_DIR):
+    import cv2
+    from console.utils import get_sample
     if sample is None:
         sample = get_sample()
     if filename is None:
@@ -49,9 +95,17 @@ def save_sample(filename=None, *, sample=None, directory=settings.SAMPLE_DIR):
 
 
 def read_sample(filename, directory=settings.SAMPLE_DIR):
+    import cv2
     img = cv2.imread(os.path.join(directory, filename))
     img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     return img
 
 
-reboot()
+# run as PYTHONSTARTUP, console.importtime only imports the module list
+if __name__ == "__main__":
+    print("Robot v%s" % __version__)
+    print()
+    setup_logging()
+    sys.excepthook = _exception_hook
+    threading.Thread(target=_background_startup, args=(globals(),), daemon=True).start()
+del setup_logging
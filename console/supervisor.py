@@ -0,0 +1,187 @@
+import time
+import logging
+import threading
+import settings
+from console import adb
+from console.client import Client, ClientException
+from console.exceptions import ConsoleException
+from console.metrics import metrics
+from console.probes import BringUp
+from console.decoder import use_inprocess
+
+
+__all__ = ("supervisor", "DevicePipeline")
+
+
+logger = logging.getLogger(__name__)
+
+
+restarts_total = metrics.counter("robobo_pipeline_restarts_total", "Pipeline restarts", ("device",))
+up = metrics.gauge("robobo_pipeline_up", "1 if the pipeline is running", ("device",))
+
+
+class DevicePipeline:
+    """Server, scrshare and client of one device."""
+
+    def __init__(self, serial=None, server_port=settings.SERVER_PORT,
+                 receiver_port=settings.RECEIVER_PORT, client=None, server=None, on_start=None):
+        if server is None and (server_port, receiver_port) != (settings.SERVER_PORT, settings.RECEIVER_PORT) \
+                and not use_inprocess() and not adb.scrshare_accepts_ports():
+            # scrshare would silently talk to the default ports of another device
+            raise ConsoleException("Can't run a pipeline on ports %d/%d: SCRSHARE_ARGS has no "
+                                   "{server_port}/{receiver_port} placeholders" % (server_port, receiver_port))
+        self.server = server or adb.DeviceServer(serial, server_port, receiver_port)
+        self.client = client or Client(server_port, receiver_port)
+        self.on_start = on_start
+        self.steps = BringUp()
+
+    @property
+    def name(self):
+        return self.server.serial
+
+    def start(self):
+        self.client.close()
+        self.steps.reset()
+        adb.register_server(self.server)
+        try:
+            if not self.server.run(self.steps):
+                raise ConsoleException("Can't start server on %s" % self.name)
+            try:
+                # connect times its own steps, video, control and first frame
+                self.client.connect(steps=self.steps)
+            except ClientException:
+                self.server.kill()
+                raise
+        finally:
+            self.steps.report()
+        if self.on_start:
+            self.on_start()
+
+    def stop(self):
+        self.client.close()
+        self.server.kill()
+
+    def check(self):
+        """Return the reason the pipeline is unhealthy, or None."""
+        if not self.server.processes_started():
+            return "process exited"
+        if not self.client.connected:
+            return "client disconnected"
+        age = time.time() - self.client.last_frame_time
+        if age > settings.SUPERVISOR_STALL_TIMEOUT:
+            return "no frames for %.0fs" % age
+        return None
+
+
+class Supervised:
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.state = "starting"
+        self.started_at = None
+        self.restarts = 0
+        self.failures = 0
+        self.last_error = None
+        self.thread = None
+
+
+class Supervisor:
+    """Brings devices up in parallel, restarts failed pipelines with
+    exponential backoff."""
+
+    def __init__(self):
+        self._items = {}
+        self._lock = threading.Lock()
+        self._running = False
+
+    def add(self, pipeline):
+        with self._lock:
+            if pipeline.name in self._items:
+                return self._items[pipeline.name]
+            item = self._items[pipeline.name] = Supervised(pipeline)
+        if self._running:
+            self._spawn(item)
+        return item
+
+    def start(self):
+        self._running = True
+        with self._lock:
+            items = list(self._items.values())
+        for item in items:
+            if item.thread is None:
+                self._spawn(item)
+
+    def stop(self):
+        self._running = False
+        with self._lock:
+            items = list(self._items.values())
+        for item in items:
+            if item.thread:
+                item.thread.join()
+                item.thread = None
+
+    def _spawn(self, item):
+        item.thread = threading.Thread(target=self._run, args=(item,), daemon=True)
+        item.thread.start()
+
+    def _run(self, item):
+        pipeline = item.pipeline
+        while self._running:
+            item.state = "starting"
+            try:
+                pipeline.start()
+            except Exception as e:
+                self._failed(item, "start failed: %s" % e)
+                continue
+            item.state = "running"
+            item.started_at = time.time()
+            item.failures = 0
+            up.labels(pipeline.name).set(1)
+            while self._running:
+                time.sleep(settings.SUPERVISOR_CHECK_INTERVAL)
+                reason = pipeline.check()
+                if reason:
+                    self._failed(item, reason)
+                    break
+        pipeline.stop()
+        up.labels(pipeline.name).set(0)
+        item.state = "stopped"
+        item.started_at = None
+
+    def _failed(self, item, reason):
+        pipeline = item.pipeline
+        item.state = "restarting"
+        item.started_at = None
+        item.last_error = reason
+        item.failures += 1
+        item.restarts += 1
+        restarts_total.labels(pipeline.name).inc()
+        up.labels(pipeline.name).set(0)
+        backoff = min(settings.SUPERVISOR_BACKOFF * 2 ** (item.failures - 1), settings.SUPERVISOR_MAX_BACKOFF)
+        logger.error("%s: %s, restart in %.0fs", pipeline.name, reason, backoff)
+        try:
+            pipeline.stop()
+        except Exception:
+            logger.exception("%s: stop failed", pipeline.name)
+        deadline = time.time() + backoff
+        while self._running and time.time() < deadline:
+            time.sleep(0.2)
+
+    def owns(self, client):
+        """True if a running pipeline drives `client`."""
+        with self._lock:
+            return self._running and any(item.pipeline.client is client for item in self._items.values())
+
+    def status(self):
+        now = time.time()
+        with self._lock:
+            items = list(self._items.values())
+        return [{
+            "device": item.pipeline.name,
+            "state": item.state,
+            "uptime": now - item.started_at if item.started_at else 0.,
+            "restarts": item.restarts,
+            "last_error": item.last_error,
+        } for item in items]
+
+
+supervisor = Supervisor()
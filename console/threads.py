@@ -1,8 +1,99 @@
+import time
 import threading
 import ctypes
+from contextlib import contextmanager
+
+
+class Cancelled(SystemExit):
+    """Raised in a worker whose cancellation token was cancelled."""
+
+
+class CancelToken:
+    def __init__(self):
+        self._event = threading.Event()
+        self._wakers = set()
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            self._event.set()
+            wakers = list(self._wakers)
+        for waker in wakers:
+            waker()
+
+    def check(self):
+        if self._event.is_set():
+            raise Cancelled()
+
+    def sleep(self, timeout):
+        """Sleep `timeout` seconds, wake up and raise Cancelled on cancel."""
+        if self._event.wait(timeout):
+            raise Cancelled()
+
+    def add_waker(self, waker):
+        """Call `waker` on cancel, used to wake up condition waits."""
+        with self._lock:
+            if not self._event.is_set():
+                self._wakers.add(waker)
+                return
+        waker()
+
+    def remove_waker(self, waker):
+        with self._lock:
+            self._wakers.discard(waker)
+
+
+class _NeverCancelled(CancelToken):
+    def sleep(self, timeout):
+        time.sleep(timeout)
+
+    def add_waker(self, waker):
+        pass
+
+
+_no_token = _NeverCancelled()
+_local = threading.local()
+
+
+def current_token():
+    """Token of the current ThreadContainer worker, never cancelled elsewhere."""
+    return getattr(_local, "token", _no_token)
+
+
+@contextmanager
+def token_context(token):
+    """Make `token` the current token of this thread for the block."""
+    prev = getattr(_local, "token", None)
+    _local.token = token
+    try:
+        yield token
+    finally:
+        if prev is None:
+            del _local.token
+        else:
+            _local.token = prev
+
+
+def check_cancelled():
+    current_token().check()
+
+
+def sleep(timeout):
+    current_token().sleep(timeout)
 
 
 class Thread(threading.Thread):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.token = CancelToken()
+
+    def cancel(self):
+        self.token.cancel()
+
     def get_id(self):
         for id, thread in threading._active.items():
             if thread is self:
@@ -20,6 +111,9 @@ class Thread(threading.Thread):
 
 
 class ThreadContainer:
+    # how long close() waits for workers to stop cooperatively
+    grace_period = 1.
+
     def __init__(self):
         self._threads = {}
         self._closed = False
@@ -32,8 +126,11 @@ class ThreadContainer:
                 if self._closed:
                     return
                 self._threads[ident] = thread
+            _local.token = thread.token
             try:
                 target(*args, **(kwargs or {}))
+            except Cancelled:
+                pass
             finally:
                 with self._lock:
                     self._threads.pop(ident, None)
@@ -45,6 +142,16 @@ class ThreadContainer:
         if self._closed:
             return
         with self._lock:
-            for thread in self._threads.values():
-                thread.raise_exception()
+            threads = list(self._threads.values())
             self._closed = True
+        for thread in threads:
+            thread.cancel()
+        deadline = time.monotonic() + self.grace_period
+        for thread in threads:
+            if thread is threading.current_thread():
+                continue
+            thread.join(max(deadline - time.monotonic(), 0))
+        for thread in threads:
+            # last resort for workers blocked in something uncancellable
+            if thread.is_alive() and thread is not threading.current_thread():
+                thread.raise_exception()
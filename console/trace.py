@@ -1,24 +1,186 @@
-import re
 import os
-import inspect
+import sys
+import json
+import time
+import struct
+import logging
+import threading
+import collections
 import cv2
 import settings
 from datetime import datetime
+from console.config import config
 
 
 TRACE_ENABLED = False
 
 
+logger = logging.getLogger(__name__)
+
+
+config.add_option("trace:queue-size", type=int, min_value=1, max_value=1000, default=64)
+config.add_option("trace:image-format", choices=("jpg", "png"), default="jpg")
+config.add_option("trace:jpeg-quality", type=int, min_value=10, max_value=100, default=75)
+config.add_option("trace:png-compression", type=int, min_value=0, max_value=9, default=1)
+config.add_option("trace:blackbox-size", type=int, min_value=1, max_value=500, default=50)
+config.add_option("trace:archive-size", type=int, min_value=1, max_value=4096, default=64)
+# blackbox frames are kept downscaled, 0.5 is ~230KB per frame instead of 900KB
+config.add_option("trace:blackbox-scale", type=float, min_value=0.1, max_value=1., default=0.5)
+
+
+ARCHIVE_EXT = ".trc"
+RECORD_HEADER = struct.Struct(">II")
+
+
+class TraceEvent:
+    __slots__ = ("time", "op", "sample", "name", "box", "module", "callers", "scale")
+
+    def __init__(self, time, op, sample, name=None, box=None, module=None, callers=(), scale=1.):
+        self.time = time
+        self.op = op
+        self.sample = sample
+        self.name = name
+        self.box = box
+        self.module = module
+        self.callers = callers
+        # `sample` is the frame resized by `scale`, `box` is in frame coordinates
+        self.scale = scale
+
+    def to_dict(self):
+        return {
+            "time": self.time,
+            "op": self.op,
+            "name": self.name,
+            "box": self.box,
+            "module": self.module,
+            "callers": self.callers,
+            "scale": self.scale
+        }
+
+
+def get_callers(depth):
+    # sys._getframe is orders of magnitude cheaper than inspect.stack(),
+    # it does not read source files
+    frame = sys._getframe(2)
+    callers = []
+    for _ in range(depth + 1):
+        if frame is None:
+            break
+        callers.append((frame.f_code.co_name, frame.f_lineno))
+        module = frame.f_code.co_filename
+        frame = frame.f_back
+    module = os.path.basename(os.path.splitext(module)[0])
+    return module, callers[::-1]
+
+
+def encode_sample(sample):
+    if config.get("trace:image-format") == "png":
+        params = [cv2.IMWRITE_PNG_COMPRESSION, config.get("trace:png-compression")]
+        return "png", cv2.imencode(".png", sample, params)[1].tobytes()
+    params = [cv2.IMWRITE_JPEG_QUALITY, config.get("trace:jpeg-quality")]
+    return "jpg", cv2.imencode(".jpg", sample, params)[1].tobytes()
+
+
+class TraceArchive:
+    """Append-only trace archive.
+
+    Every record is a pair of big-endian uint32 lengths followed by a JSON
+    header and an encoded frame. A frame shared by several events is stored
+    once, later records point to it by `frame` number and have no payload.
+    A truncated last record (crash) is ignored by the reader.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._frames = 0
+        self._last_sample = None
+
+    @property
+    def size(self):
+        return self._file.tell() if self._file else 0
+
+    def add(self, event):
+        header = event.to_dict()
+        payload = b""
+        if event.sample is not None:
+            if event.sample is not self._last_sample:
+                self._last_sample = event.sample
+                self._frames += 1
+                header["format"], payload = encode_sample(event.sample)
+            header["frame"] = self._frames
+        header = json.dumps(header).encode("utf-8")
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = open(self.path, "ab")
+        self._file.write(RECORD_HEADER.pack(len(header), len(payload)))
+        self._file.write(header)
+        self._file.write(payload)
+
+    def flush(self):
+        if self._file:
+            self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+        self._last_sample = None
+
+
+def read_archive(path, with_frames=False):
+    """Yield `(header, payload)` for every record in the archive.
+    Payloads are skipped (None) unless `with_frames` is set.
+    """
+    with open(path, "rb") as f:
+        while 1:
+            data = f.read(RECORD_HEADER.size)
+            if len(data) < RECORD_HEADER.size:
+                return
+            header_size, payload_size = RECORD_HEADER.unpack(data)
+            data = f.read(header_size)
+            if len(data) < header_size:
+                return
+            header = json.loads(data.decode("utf-8"))
+            if with_frames:
+                payload = f.read(payload_size)
+                if len(payload) < payload_size:
+                    return
+            else:
+                payload = None
+                f.seek(payload_size, os.SEEK_CUR)
+            yield header, payload
+
+
 class Trace:
     def __init__(self):
         self.enabled = False
+        self.blackbox = False
         self.suppressed = []
+        self.dropped = 0
+        self._ring = collections.deque()
+        self._ring_last = (None, None, None)
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._writer = None
+        self._busy = False
+        self._archive = None
 
-    def enable(self):
+    def enable(self, blackbox=False):
+        """Enable tracing.
+        With `blackbox` the last traced frames are kept in memory and written
+        to disk only by `dump` (on unexpected failures).
+        """
         self.enabled = True
+        self.blackbox = blackbox
+        self._ring = collections.deque(maxlen=config.get("trace:blackbox-size"))
+        self._start_writer()
 
     def disable(self):
         self.enabled = False
+        self._ring.clear()
+        self._ring_last = (None, None, None)
+        self._put(self.close_archive)
 
     def suppress(self, item):
         self.suppressed.append(item)
@@ -28,30 +190,99 @@ class Trace:
             return False
         if match in self.suppressed:
             return False
-        sample = sample.copy()
-        os.makedirs(settings.TRACE_DIR, exist_ok=True)
-        if match:
-            cv2.rectangle(sample, (match.left + 2, match.top + 2), (match.right - 2, match.bottom - 2), 0, 2)
-            cv2.rectangle(sample, (match.left, match.top), (match.right, match.bottom), 255, 2)
-        stack = inspect.stack()[1: trace_frame + 2]
-        fi = stack[-1]
-        path = os.path.splitext(fi.filename)[0]
-        module_name = os.path.basename(path)
-        time_prefix = datetime.now().strftime("%H_%M_%S_%f")[:-3]
-        funcs = "--".join("%s_%s" % (fi.function, fi.lineno) for fi in reversed(stack))
-        name = (
-            time_prefix,
-            module_name,
-            funcs,
-            op
-        )
-        match_name = match.name.replace("/", "_")
-        if len(match_name) > 40:
-            match_name = match_name[:37] + "..."
-        name += ("<" + match_name + ">",)
-        image_name = "--".join(name) + ".png"
-        cv2.imwrite(os.path.join(settings.TRACE_DIR, image_name), sample)
+        module, callers = get_callers(trace_frame)
+        box = (match.left, match.top, match.right, match.bottom) if match else None
+        if self.blackbox:
+            scale = config.get("trace:blackbox-scale")
+            event = TraceEvent(time.time(), op, self._compact(sample, scale), match.name, box, module, callers, scale)
+            self._ring.append(event)
+        else:
+            # written right away, samples are not modified in place
+            event = TraceEvent(time.time(), op, sample, match.name, box, module, callers)
+            self._put(self.write, event)
+        return True
+
+    def _compact(self, sample, scale):
+        # an own downscaled copy, shared by the events of the same sample
+        last_sample, last_scale, last_copy = self._ring_last
+        if sample is last_sample and scale == last_scale:
+            return last_copy
+        if scale < 1:
+            copy = cv2.resize(sample, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        else:
+            copy = sample.copy()
+        self._ring_last = (sample, scale, copy)
+        return copy
+
+    def annotate(self, note):
+        if self.enabled and self.blackbox:
+            self._ring.append(TraceEvent(time.time(), note, None))
+
+    def dump(self, reason="manual"):
+        if not self.enabled or not self.blackbox or not self._ring:
+            return False
+        events = list(self._ring)
+        self._ring.clear()
+        self._ring_last = (None, None, None)
+        time_prefix = datetime.fromtimestamp(events[-1].time).strftime("%Y%m%d_%H%M%S_%f")[:-3]
+        name = "blackbox--%s--%s" % (time_prefix, reason)
+        self._put(self.write_dump, name, events)
         return True
 
+    def _put(self, fn, *args):
+        with self._cond:
+            # drop the oldest items instead of blocking the bot
+            while len(self._queue) >= config.get("trace:queue-size"):
+                self._queue.popleft()
+                self.dropped += 1
+            self._queue.append((fn, args))
+            self._cond.notify()
+
+    def flush(self, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._queue and not self._busy, timeout)
+
+    def _start_writer(self):
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._writer_loop, daemon=True)
+            self._writer.start()
+
+    def _writer_loop(self):
+        while 1:
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+                self._cond.wait_for(lambda: self._queue)
+                fn, args = self._queue.popleft()
+                self._busy = True
+            try:
+                fn(*args)
+                if not self._queue and self._archive:
+                    self._archive.flush()
+            except Exception:
+                logger.exception("could not write trace event")
+
+    def write_dump(self, name, events):
+        archive = TraceArchive(os.path.join(settings.TRACE_DIR, name + ARCHIVE_EXT))
+        try:
+            for event in events:
+                archive.add(event)
+        finally:
+            archive.close()
+
+    def write(self, event):
+        if self._archive and self._archive.size > config.get("trace:archive-size") << 20:
+            self.close_archive()
+        if self._archive is None:
+            # microseconds, archives may roll over within a second
+            name = datetime.fromtimestamp(event.time).strftime("%Y%m%d_%H%M%S_%f")
+            self._archive = TraceArchive(os.path.join(settings.TRACE_DIR, name + ARCHIVE_EXT))
+        self._archive.add(event)
+
+    def close_archive(self):
+        if self._archive:
+            self._archive.close()
+            self._archive = None
+
 
 trace = Trace()
@@ -0,0 +1,97 @@
+"""Trace archive viewer.
+
+    python -m console.traceview list trace/20201010_101010_000000.trc
+    python -m console.traceview extract trace/20201010_101010_000000.trc -o frames --op "<timeout>"
+"""
+import os
+import sys
+import argparse
+import cv2
+import numpy as np
+from datetime import datetime
+from console.trace import read_archive
+
+
+def format_time(tm, fmt="%H:%M:%S.%f"):
+    return datetime.fromtimestamp(tm).strftime(fmt)[:-3]
+
+
+def format_callers(callers, sep=" "):
+    return sep.join("%s:%s" % tuple(caller) for caller in callers)
+
+
+def select(header, op=None, name=None):
+    if op is not None and header["op"] != op:
+        return False
+    if name is not None and name not in (header["name"] or ""):
+        return False
+    return True
+
+
+def list_archive(path, op=None, name=None, out=sys.stdout):
+    for header, _ in read_archive(path):
+        if not select(header, op, name):
+            continue
+        if header.get("frame") is None:
+            out.write("%s %s\n" % (format_time(header["time"]), header["op"]))
+            continue
+        out.write("%s #%-5d %s %s %s %r %s\n" % (
+            format_time(header["time"]),
+            header["frame"],
+            header["module"],
+            format_callers(header["callers"]),
+            header["op"],
+            header["name"],
+            header["box"] or ""
+        ))
+
+
+def extract_archive(path, directory, op=None, name=None):
+    os.makedirs(directory, exist_ok=True)
+    frame = None
+    count = 0
+    for header, payload in read_archive(path, with_frames=True):
+        if payload:
+            frame = payload
+        if header.get("frame") is None or not select(header, op, name):
+            continue
+        sample = cv2.imdecode(np.frombuffer(frame, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        if header["box"]:
+            # blackbox frames are stored downscaled
+            scale = header.get("scale", 1)
+            left, top, right, bottom = (int(x * scale) for x in header["box"])
+            cv2.rectangle(sample, (left + 2, top + 2), (right - 2, bottom - 2), 0, 2)
+            cv2.rectangle(sample, (left, top), (right, bottom), 255, 2)
+        match_name = header["name"].replace("/", "_")
+        if len(match_name) > 40:
+            match_name = match_name[:37] + "..."
+        image_name = "--".join((
+            format_time(header["time"], "%H_%M_%S_%f"),
+            header["module"],
+            format_callers(header["callers"], "--").replace(":", "_"),
+            header["op"],
+            "<" + match_name + ">"
+        )) + ".png"
+        cv2.imwrite(os.path.join(directory, image_name), sample)
+        count += 1
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m console.traceview")
+    parser.add_argument("command", choices=("list", "extract"))
+    parser.add_argument("archive")
+    parser.add_argument("-o", "--output", default=None, help="directory for extracted frames")
+    parser.add_argument("--op", default=None, help="only events with this op, e.g. <timeout>")
+    parser.add_argument("--name", default=None, help="only events whose match name contains this")
+    args = parser.parse_args(argv)
+    if args.command == "list":
+        list_archive(args.archive, op=args.op, name=args.name)
+    else:
+        directory = args.output or os.path.splitext(args.archive)[0]
+        count = extract_archive(args.archive, directory, op=args.op, name=args.name)
+        print("%d frames extracted to %s" % (count, directory))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,22 @@ import wx
 import sys
 import logging
 import time
+import threading
+import collections
+import cv2
+import numpy as np
 from pubsub import pub
+import settings
 from console import __version__
-from console import threads
+from console.executor import Executor, JobRejected
 from console import environ
 from console import arena
+from console import exporter
 from console.exceptions import ConsoleException
 from console.config import config
 from console.client import client
+from console.utils import recent_matches
+from console.metrics import metrics
 from console.logging import setup_logging
 
 
@@ -23,18 +31,145 @@ def _exception_hook(exctype, value, traceback):
         sys.__excepthook__(exctype, value, traceback)
 
 
+# records waiting for the next flush, oldest are dropped if the UI lags
+_log_buffer = collections.deque(maxlen=settings.UI_LOG_LINES)
+
+
 class UIHandler(logging.Handler):
     def emit(self, record):
-        msg = self.format(record)
-        wx.CallAfter(pub.sendMessage, "logging", msg=msg)
+        _log_buffer.append(self.format(record))
+
+
+def flush_log_buffer():
+    msgs = []
+    while _log_buffer:
+        msgs.append(_log_buffer.popleft())
+    if msgs:
+        pub.sendMessage("logging", msgs=msgs)
+
+
+def render_preview(buf, width):
+    key, frame_width, frame_height, data = buf
+    scale = width / frame_width
+    height = int(frame_height * scale)
+    frame = np.frombuffer(data, dtype=np.uint8).reshape((frame_height, frame_width))
+    # the only copy of the frame, and it is already downscaled
+    image = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+    image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+    now = time.time()
+    for tm, match in list(recent_matches):
+        if now - tm > settings.UI_PREVIEW_MATCH_TTL:
+            continue
+        top_left = (int(match.left * scale), int(match.top * scale))
+        bottom_right = (int(match.right * scale), int(match.bottom * scale))
+        cv2.rectangle(image, top_left, bottom_right, (255, 64, 64), 1)
+        cv2.putText(image, match.name, (top_left[0], max(top_left[1] - 3, 8)),
+                    cv2.FONT_HERSHEY_PLAIN, 0.7, (255, 64, 64), 1)
+    return width, height, image.tobytes()
+
+
+class PreviewPanel(wx.Panel):
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self._bitmap = None
+        self._prev_key = None
+        self._pending = threading.Event()
+        self.SetMinSize((settings.UI_PREVIEW_WIDTH, settings.UI_PREVIEW_WIDTH * 9 // 16))
+        self.SetBackgroundStyle(wx.BG_STYLE_PAINT)
+        self.Bind(wx.EVT_PAINT, self.on_paint)
+
+    def on_paint(self, event):
+        dc = wx.AutoBufferedPaintDC(self)
+        dc.SetBackground(wx.BLACK_BRUSH)
+        dc.Clear()
+        if self._bitmap:
+            dc.DrawBitmap(self._bitmap, 0, 0)
+
+    def set_image(self, width, height, data):
+        try:
+            if width and height:
+                self._bitmap = wx.Bitmap.FromBuffer(width, height, data)
+            else:
+                self._bitmap = None
+            self.Refresh(eraseBackground=False)
+        finally:
+            self._pending.clear()
+
+    def tick(self):
+        if self._pending.is_set():
+            # the GUI has not shown the previous image yet
+            return
+        buf = client.videobuf
+        key = buf[0] if buf else None
+        if key == self._prev_key:
+            return
+        self._prev_key = key
+        if buf:
+            image = render_preview(buf, settings.UI_PREVIEW_WIDTH)
+        else:
+            image = (0, 0, None)
+        self._pending.set()
+        wx.CallAfter(self.set_image, *image)
+
+
+class PerfDashboard:
+    """Text summary of the performance counters, rates are per interval."""
+
+    def __init__(self):
+        self._prev = {}
+
+    def _delta(self, key, value):
+        prev = self._prev.get(key, 0)
+        self._prev[key] = value
+        return value - prev
+
+    def _histogram_delta(self, key, child):
+        count, total, _ = child.snapshot()
+        return self._delta(key + ":count", count), self._delta(key + ":sum", total)
+
+    def render(self, fps, interval):
+        lines = ["stream     %6.1f fps" % fps]
+        last_frame = metrics.get("robobo_last_frame_timestamp_seconds").value
+        if last_frame:
+            lines.append("frame age  %6.0f ms" % ((time.time() - last_frame) * 1000))
+
+        hot = []
+        calls = cost = 0
+        for (name,), child in metrics.get("robobo_template_match_seconds").children():
+            count, total = self._histogram_delta("match:" + name, child)
+            calls += count
+            cost += total
+            if count:
+                hot.append((total, count, name))
+        lines.append("match      %6.0f /s  %5.2f ms" % (
+            calls / interval, cost / calls * 1000 if calls else 0))
+        for total, count, name in sorted(hot, reverse=True)[:5]:
+            lines.append("  %-28s %4.0f%% %5.2f ms" % (
+                name[-28:], total / interval * 100, total / count * 1000))
+
+        waits = sum(self._delta("wait:" + op, child.value)
+                    for (op,), child in metrics.get("robobo_waits_total").children())
+        timeouts = sum(self._delta("timeout:" + op, child.value)
+                       for (op,), child in metrics.get("robobo_wait_timeouts_total").children())
+        lines.append("waits      %6d    timeouts %d" % (waits, timeouts))
+
+        count, total = self._histogram_delta("click", metrics.get("robobo_click_latency_seconds"))
+        if count:
+            lines.append("click      %6.0f ms" % (total / count * 1000))
+
+        for (phase,), child in metrics.get("robobo_arena_phase_seconds").children():
+            count, total, _ = child.snapshot()
+            if count:
+                lines.append("%-10s %6.1f s   x%d" % (phase, total / count, count))
+        return "\n".join(lines)
 
 
 class AppFrame(wx.Frame):
     def __init__(self, *args, **kw):
         # ensure the parent's __init__ is called
         super().__init__(*args, **kw)
-        self._thead_container = threads.ThreadContainer()
-        self._arena_thread = None
+        self.executor = Executor(settings.UI_LANES)
+        self._arena_job = None
         self.init_ui()
         self.setup_logging()
 
@@ -55,7 +190,7 @@ class AppFrame(wx.Frame):
         vbox1.Add(self.reboot_button)
         button = wx.Button(panel, label="Clear log", size=(100, -1))
         button.SetFont(font)
-        button.Bind(wx.EVT_BUTTON, lambda e: self.logger.Clear())
+        button.Bind(wx.EVT_BUTTON, lambda e: self.clear_log())
         vbox1.Add(button, 0, wx.TOP, 5)
         hbox.Add(vbox1, 0, wx.EXPAND, 0)
 
@@ -135,10 +270,23 @@ class AppFrame(wx.Frame):
             style=wx.TE_MULTILINE | wx.TE_READONLY
         )
         self.logger.SetFont(font)
-        vbox.Add(self.logger, 1, wx.EXPAND | wx.ALL, 10)
+        self._log_lines = 0
+        hbox = wx.BoxSizer(wx.HORIZONTAL)
+        hbox.Add(self.logger, 1, wx.EXPAND)
+        vbox1 = wx.BoxSizer(wx.VERTICAL)
+        self.preview = PreviewPanel(panel)
+        vbox1.Add(self.preview)
+        self.dashboard = wx.StaticText(panel, label="")
+        self.dashboard.SetFont(wx.Font(9, wx.FONTFAMILY_TELETYPE, wx.FONTSTYLE_NORMAL, wx.FONTWEIGHT_NORMAL))
+        vbox1.Add(self.dashboard, 1, wx.EXPAND | wx.TOP, 10)
+        hbox.Add(vbox1, 0, wx.EXPAND | wx.LEFT, 10)
+        vbox.Add(hbox, 1, wx.EXPAND | wx.ALL, 10)
 
         panel.SetSizer(vbox)
         pub.subscribe(self.logger_listener, "logging")
+        self.log_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, lambda e: flush_log_buffer(), self.log_timer)
+        self.log_timer.Start(settings.UI_LOG_FLUSH_INTERVAL)
 
     def set_arena_type(self, ev):
         arena.set_arena_type(int(ev.GetString()))
@@ -168,12 +316,21 @@ class AppFrame(wx.Frame):
             else:
                 arena.set_arena_run_count(value)
 
-    def start_stop_arena(self, ev):
-        if self._arena_thread:
+    def stop_arena(self):
+        if self._arena_job:
             self.start_arena_button.SetLabelText("Start arena")
             self.arena_counter.SetLabelText("")
-            self._arena_thread.raise_exception()
-            self._arena_thread = None
+            self._arena_job.cancel()
+            self._arena_job = None
+            self.idle_capture()
+
+    def idle_capture(self):
+        # queued after the arena job on the device lane
+        self.run_job("device", "idle capture", environ.switch_capture, args=(True,))
+
+    def start_stop_arena(self, ev):
+        if self._arena_job:
+            self.stop_arena()
         else:
             run_count = config.get("arena:run-count")
             if run_count < 1:
@@ -182,24 +339,27 @@ class AppFrame(wx.Frame):
             num = 1
 
             def run_arena():
-                self.start_arena_button.SetLabelText("Stop arena")
-                self.arena_counter.SetLabelText("arena #%s" % num)
-                self._arena_thread = self.run_in_thread(
+                self._arena_job = self.run_job(
+                    "device", "arena",
                     arena.start_arena_once,
                     args=(num,),
                     after=restart
                 )
+                if self._arena_job:
+                    self.start_arena_button.SetLabelText("Stop arena")
+                    self.arena_counter.SetLabelText("arena #%s" % num)
 
-            def restart():
+            def restart(job):
                 nonlocal num
                 num += 1
-                if self._arena_thread is None:
+                if self._arena_job is not job:
                     return
                 count = config.get("arena:run-count")
-                if num > count:
+                if num > count or job.status != "done":
                     self.start_arena_button.SetLabelText("Start arena")
                     self.arena_counter.SetLabelText("")
-                    self._arena_thread = None
+                    self._arena_job = None
+                    self.idle_capture()
                 else:
                     run_arena()
 
@@ -209,22 +369,42 @@ class AppFrame(wx.Frame):
         setup_logging("console.ui.UIHandler")
         sys.excepthook = _exception_hook
 
-    def logger_listener(self, msg):
-        self.logger.AppendText(msg + "\n")
+    def logger_listener(self, msgs):
+        msgs = msgs[-settings.UI_LOG_LINES:]
+        self.logger.Freeze()
+        try:
+            self.logger.AppendText("\n".join(msgs) + "\n")
+            # records may span several lines (tracebacks), count lines
+            self._log_lines += sum(m.count("\n") + 1 for m in msgs)
+            excess = self._log_lines - settings.UI_LOG_LINES
+            if excess > 0:
+                self.logger.Remove(0, self.logger.XYToPosition(0, excess))
+                self._log_lines -= excess
+        finally:
+            self.logger.Thaw()
+
+    def clear_log(self):
+        self.logger.Clear()
+        self._log_lines = 0
 
     def on_close(self, event=None):
-        self._thead_container.close()
+        self.log_timer.Stop()
+        self.executor.close()
         client.close()
         self.Destroy()
 
     def init(self):
+        exporter.start_exporter()
         self.start_fps_watcher()
+        self.executor.schedule("analysis", "preview", self.preview.tick, 1. / settings.UI_PREVIEW_FPS)
         self.reboot()
 
     def reboot(self, event=None):
-        self.reboot_button.Disable()
-        self.logger.Clear()
-        self.run_in_thread(environ.reboot, after=self.reboot_button.Enable)
+        # the arena loop would fight with the reboot over the client
+        self.stop_arena()
+        if self.run_job("device", "reboot", environ.reboot, after=lambda job: self.reboot_button.Enable()):
+            self.reboot_button.Disable()
+            self.clear_log()
 
     def start_fps_watcher(self):
         def set_fps_value(value):
@@ -234,31 +414,39 @@ class AppFrame(wx.Frame):
                 self.start_arena_button.Enable()
             self.fps_label.SetLabelText(value)
 
+        dashboard = PerfDashboard()
+        prev_count = 0
+        tm = time.time()
+
         def watcher():
-            prev_key = 0
-            while 1:
-                tm = time.time()
-                time.sleep(1)
-                buf = client.videobuf
-                if not buf:
-                    wx.CallAfter(set_fps_value, "OFFLINE")
-                    continue
-                delta = time.time() - tm
-                new_key = buf[0]
-                fps = (new_key - prev_key) / delta
-                prev_key = new_key
-                wx.CallAfter(set_fps_value, "{:.1f}".format(fps))
-
-        self._thead_container.run(watcher)
-
-    def run_in_thread(self, func, args=(), kwargs=None, *, after=None):
-        def thread_func():
-            try:
-                func(*args, **(kwargs or {}))
-            finally:
-                if after:
-                    wx.CallAfter(after)
-        return self._thead_container.run(thread_func)
+            nonlocal prev_count, tm
+            if not client.videobuf:
+                prev_count, tm = 0, time.time()
+                wx.CallAfter(set_fps_value, "OFFLINE")
+                return
+            now = time.time()
+            delta, tm = now - tm, now
+            # skipped frames count too, the stream rate is shown
+            count = client.received_count
+            if count < prev_count:
+                # reconnected
+                prev_count = 0
+            fps = (count - prev_count) / delta
+            prev_count = count
+            wx.CallAfter(set_fps_value, "{:.1f}".format(fps))
+            wx.CallAfter(self.dashboard.SetLabelText, dashboard.render(fps, delta))
+
+        self.executor.schedule("ui", "fps", watcher, 1.)
+
+    def run_job(self, lane, name, func, args=(), kwargs=None, *, after=None):
+        try:
+            job = self.executor.submit(lane, name, func, *args, **(kwargs or {}))
+        except JobRejected as e:
+            logging.getLogger("console").info(e.msg)
+            return None
+        if after:
+            job.add_done_callback(lambda job: wx.CallAfter(after, job))
+        return job
 
 
 def run_app():
@@ -266,7 +454,7 @@ def run_app():
     frm = AppFrame(
         None,
         title="Robobo %s" % __version__,
-        size=(800, 600)
+        size=(1140, 600)
     )
     frm.Show()
     frm.init()
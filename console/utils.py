@@ -1,12 +1,19 @@
 import os
+import atexit
 import time
+import threading
+import collections
 import cv2
 import numpy as np
 import settings
 import logging
 from console.client import client
+from console import threads
 from console.config import config
 from console.trace import trace
+from console.interrupts import Interrupted
+from console.metrics import metrics
+from console.analyzer import analyzer
 
 
 __all__ = ("wait", "find", "find_all", "click", "click_mouse", "mouse_move",
@@ -17,6 +24,14 @@ __all__ = ("wait", "find", "find_all", "click", "click_mouse", "mouse_move",
 logger = logging.getLogger(__name__)
 
 
+match_seconds = metrics.histogram(
+    "robobo_template_match_seconds", "matchTemplate duration", ("template",))
+waits_total = metrics.counter("robobo_waits_total", "wait/wait_while calls", ("op",))
+wait_timeouts_total = metrics.counter("robobo_wait_timeouts_total", "wait/wait_while timeouts", ("op",))
+click_latency_seconds = metrics.histogram(
+    "robobo_click_latency_seconds", "Time from a match to the click on it")
+
+
 class Match:
 
     logger = None
@@ -27,6 +42,7 @@ class Match:
         self.top = top
         self.width = width
         self.height = height
+        self.time = time.time()
 
     def set_logger(self, logger):
         self.logger = logger
@@ -47,7 +63,10 @@ class Match:
         y = self.top + h2
         rand_x = 0 if w2 < 10 else w2 // 2
         rand_y = 0 if h2 < 10 else h2 // 2
+        click_latency_seconds.observe(time.time() - self.time)
         point = client.click(x, y, rand_x=rand_x, rand_y=rand_y)
+        if point is None:
+            return False
         (self.logger or logger).info("click on [%r, %r]", self, point)
         return True
 
@@ -119,11 +138,18 @@ class Template:
     def __init__(self, name, img):
         self.name = name
         self.img = img
+        self._match_seconds = match_seconds.labels(name)
+
+    def match_template(self, sample):
+        tm = time.perf_counter()
+        res = cv2.matchTemplate(sample, self.img, cv2.TM_CCOEFF_NORMED)
+        self._match_seconds.observe(time.perf_counter() - tm)
+        return res
 
     def match(self, sample=None):
         if sample is None:
             sample = client.get_sample()
-        res = cv2.matchTemplate(sample, self.img, cv2.TM_CCOEFF_NORMED)
+        res = self.match_template(sample)
         if len(res):
             _, coef, _, _ = cv2.minMaxLoc(res)
             return coef
@@ -133,7 +159,7 @@ class Template:
         threshold = threshold or settings.IMAGE_SEARCH_TRHESHOLD
         if sample is None:
             sample = client.get_sample()
-        res = cv2.matchTemplate(sample, self.img, cv2.TM_CCOEFF_NORMED)
+        res = self.match_template(sample)
         if len(res):
             _, coef, _, match = cv2.minMaxLoc(res)
             if coef >= threshold:
@@ -145,7 +171,7 @@ class Template:
         threshold = threshold or settings.IMAGE_SEARCH_TRHESHOLD
         if sample is None:
             sample = client.get_sample()
-        res = cv2.matchTemplate(sample, self.img, cv2.TM_CCOEFF_NORMED)
+        res = self.match_template(sample)
         loc = np.where(res >= threshold)
         return self.without_intersections(zip(*loc[::-1]))
 
@@ -165,11 +191,26 @@ class Template:
 
 
 class Templates(dict):
+    """Templates resized to the scale of the current capture profile."""
+
+    _scale = (1., 1.)
+
+    def __getitem__(self, key):
+        scale = client.geometry.scale
+        if scale != self._scale:
+            # the profile has changed, reload at the new scale
+            self.clear()
+            self._scale = scale
+        return super().__getitem__(key)
+
     def __missing__(self, key):
         if isinstance(key, Template):
             return self[key.name]
         img = cv2.imread(os.path.join(settings.TEMPLATE_DIR, key + ".png"))
         img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if self._scale != (1., 1.):
+            height, width = img.shape
+            img = cv2.resize(img, client.geometry.to_frame_size(width, height), interpolation=cv2.INTER_AREA)
         tpl = Template(key, img)
         self[key] = tpl
         return tpl
@@ -178,33 +219,127 @@ class Templates(dict):
 templates = Templates()
 
 
+# latest matches on full frames, shown by the UI preview
+recent_matches = collections.deque(maxlen=16)
+
+
+def remember_match(sample, match):
+    if sample.shape == client.geometry.shape:
+        recent_matches.append((time.time(), match))
+
+
+def resume_after_interrupt():
+    # time spent blocked by an interrupt does not count against timeouts
+    tm = time.time()
+    if not client.interrupts.checkpoint():
+        return 0
+    client.new_sample()
+    return time.time() - tm
+
+
+_match_pool = None
+_match_pool_lock = threading.Lock()
+
+
+def get_match_pool():
+    """Process pool matching templates on shared frames, None if disabled.
+    Only multi-target find/wait is offloaded, find_all stays in-process."""
+    global _match_pool
+    processes = config.get("utils:match-workers")
+    if not processes:
+        return None
+    with _match_pool_lock:
+        if _match_pool is None:
+            from console.framepool import FrameRing, MatchPool
+            ring = FrameRing(config.get("utils:match-ring-size"), *client.geometry.shape)
+            try:
+                _match_pool = MatchPool(ring, client.geometry, processes)
+            except Exception:
+                ring.close()
+                raise
+            client.frame_ring = ring
+            logger.info("Match pool started (%d workers).", processes)
+        return _match_pool
+
+
+def stop_match_pool():
+    global _match_pool
+    with _match_pool_lock:
+        if _match_pool is not None:
+            client.frame_ring = None
+            _match_pool.close()
+            _match_pool.ring.close()
+            _match_pool = None
+
+
+atexit.register(stop_match_pool)
+
+
+def find_first(targets, sample, key=None, threshold=None):
+    """First of `targets` found on `sample`. Results on a full frame `key`
+    are shared through the analyzer, several targets are matched in parallel
+    by the match pool, when it is enabled."""
+    pool = get_match_pool() if key is not None and len(targets) > 1 else None
+    if pool is not None:
+        results = pool.find_all_targets(key, targets, threshold)
+        if results is not None:
+            for t in targets:
+                if results[t]:
+                    return Match(t, *results[t])
+            return None
+    for t in targets:
+        if key is None:
+            match = templates[t].find(sample=sample, threshold=threshold)
+        else:
+            match = analyzer.find(key, sample, templates[t], threshold=threshold)
+        if match:
+            return match
+
+
+def subscribed(owner, targets, region=None, threshold=None):
+    """Have the analyzer match `targets` on every new frame while active."""
+    if isinstance(targets, str):
+        targets = (targets,)
+    return analyzer.subscribed(owner, [templates[t] for t in targets], region, threshold)
+
+
 def wait(
         targets,
         timeout=...,
         logger=None,
         threshold=None,
         can_trace=True,
-        trace_frame=0
+        trace_frame=0,
+        dump_on_timeout=False
 ):
+    """Wait for the first of `targets`. With `dump_on_timeout` a timeout is
+    unexpected and dumps the trace blackbox."""
     trace_frame += 1
     if isinstance(targets, str):
         targets = (targets,)
     if timeout is ...:
         timeout = config.get("utils:default-wait-timeout")
     target_names = ", ".join(targets)
+    waits_total.labels("wait").inc()
     tm = time.time()
     while 1:
-        sample = client.get_sample()
-        for t in targets:
-            match = templates[t].find(sample=sample, threshold=threshold)
-            if match:
-                if can_trace:
-                    trace.trace("<done>", sample, match, trace_frame=trace_frame)
-                return match.set_logger(logger)
+        threads.check_cancelled()
+        tm += resume_after_interrupt()
+        key, sample = client.get_keyed_sample()
+        match = find_first(targets, sample, key, threshold)
+        if match:
+            remember_match(sample, match)
+            if can_trace:
+                trace.trace("<done>", sample, match, trace_frame=trace_frame)
+            return match.set_logger(logger)
         if timeout is not None and (time.time() - tm) > timeout:
             match = NoMatch(targets).set_logger(logger)
             if can_trace:
                 trace.trace("<timeout>", sample, match, trace_frame=trace_frame)
+            if timeout:
+                wait_timeouts_total.labels("wait").inc()
+                if dump_on_timeout:
+                    trace.dump("timeout")
             return match
         if logger and tm - time.time() > 2.:
             logger.info("waiting [%s]", target_names, extra={"rate": 1/5})
@@ -217,23 +352,25 @@ def wait_while(
         logger=None,
         threshold=None,
         can_trace=True,
-        trace_frame=0
+        trace_frame=0,
+        dump_on_timeout=False
 ):
     trace_frame += 1
     if isinstance(targets, str):
         targets = (targets,)
     if timeout is ...:
         timeout = config.get("utils:default-wait-timeout")
+    waits_total.labels("wait_while").inc()
     tm = time.time()
     attempt = 1
     while 1:
-        sample = client.get_sample()
-        for t in targets:
-            match = templates[t].find(sample=sample, threshold=threshold)
-            if match:
-                if logger and tm - time.time() > 2.:
-                    logger.info("still can find [%s]", match, extra={"rate": 1/5})
-                break
+        threads.check_cancelled()
+        tm += resume_after_interrupt()
+        key, sample = client.get_keyed_sample()
+        match = find_first(targets, sample, key, threshold)
+        if match:
+            if logger and tm - time.time() > 2.:
+                logger.info("still can find [%s]", match, extra={"rate": 1/5})
         else:
             if can_trace:
                 match = NoMatch(targets)
@@ -242,6 +379,10 @@ def wait_while(
         if timeout is not None and (time.time() - tm) > timeout:
             if can_trace:
                 trace.trace("<timeout>", sample, match, trace_frame=trace_frame)
+            if timeout:
+                wait_timeouts_total.labels("wait_while").inc()
+                if dump_on_timeout:
+                    trace.dump("timeout")
             return False
         client.new_sample()
         attempt += 1
@@ -258,14 +399,15 @@ def find(
     trace_frame += 1
     if isinstance(targets, str):
         targets = (targets,)
+    key = None
     if sample is None:
-        sample = client.get_sample()
-    for t in targets:
-        match = templates[t].find(sample=sample, threshold=threshold)
-        if match:
-            if can_trace:
-                trace.trace("<done>", sample, match, trace_frame=trace_frame)
-            return match.set_logger(logger)
+        key, sample = client.get_keyed_sample()
+    match = find_first(targets, sample, key, threshold)
+    if match:
+        remember_match(sample, match)
+        if can_trace:
+            trace.trace("<done>", sample, match, trace_frame=trace_frame)
+        return match.set_logger(logger)
     return NoMatch(targets).set_logger(logger)
 
 
@@ -286,17 +428,48 @@ def click_and_check(*args, timeout=..., check_timeout=..., trace_frame=0, **kwar
     return False
 
 
-click_mouse = client.click
-mouse_move = client.move
+def click_mouse(x, y, rand_x=None, rand_y=None):
+    """Click at a screen position, mapped to the capture profile.
+    Returns None if the click is dropped: outside the captured area, or
+    blocked by an interrupt outside of resample_loop.
+    """
+    geometry = client.geometry
+    frame_x, frame_y = geometry.to_frame(x, y)
+    if not geometry.in_frame(frame_x, frame_y):
+        # outside the crop of the capture profile
+        logger.warning("click at (%d, %d) is outside the captured area, skipped", x, y)
+        return None
+    x, y = frame_x, frame_y
+    if rand_x:
+        rand_x = max(int(rand_x * geometry.scale_x), 1)
+    if rand_y:
+        rand_y = max(int(rand_y * geometry.scale_y), 1)
+    return client.click(x, y, rand_x=rand_x, rand_y=rand_y)
+
+
+def mouse_move(x1, y1, x2, y2):
+    """Swipe between screen positions, mapped to the capture profile."""
+    geometry = client.geometry
+    start, end = geometry.to_frame(x1, y1), geometry.to_frame(x2, y2)
+    if not geometry.in_frame(*start) or not geometry.in_frame(*end):
+        logger.warning("swipe (%d, %d) -> (%d, %d) is outside the captured area, skipped", x1, y1, x2, y2)
+        return
+    client.move(*start, *end)
 
 
 def reshaped_sample(left=0, top=0, right=0, bottom=0, sample=None):
+    """Part of the screen, margins are fractions of the screen size."""
     assert 0 <= left <= 1
     assert 0 <= top <= 1
     assert 0 <= right <= 1
     assert 0 <= bottom <= 1
     if sample is None:
         sample = client.get_sample()
+    if sample.shape == client.geometry.shape:
+        w, h = settings.SCREEN_WIDTH, settings.SCREEN_HEIGHT
+        x, y = int(w * left), int(h * top)
+        return get_sample_part(x, y, int(w * (1 - right)) - x, int(h * (1 - bottom)) - y, sample=sample)
+    # not a full frame, the margins are relative to the sample itself
     w, h = sample.shape[::-1]
     left = int(w * left)
     right = int(w * (1 - right))
@@ -306,8 +479,10 @@ def reshaped_sample(left=0, top=0, right=0, bottom=0, sample=None):
 
 
 def get_sample_part(x, y, width, height, sample=None):
+    """Screen rectangle of a full frame."""
     if sample is None:
         sample = client.get_sample()
+    x, y, width, height = client.geometry.to_frame_rect(x, y, width, height)
     return sample[y:y + height, x:x + width]
 
 
@@ -333,7 +508,7 @@ class LoopObj:
         if self._min_timeout:
             delta = time.time() - self._last_time
             if delta < self._min_timeout:
-                time.sleep(self._min_timeout - delta)
+                threads.sleep(self._min_timeout - delta)
         client.new_sample()
         self.reset_timer()
 
@@ -375,12 +550,17 @@ def resample_loop(min_timeout=0, logger=None, force_resample=False):
             else:
                 loop_obj.reset_timer()
             while 1:
+                threads.check_cancelled()
                 try:
-                    return fn(*args, **kwargs, loop=loop_obj)
+                    with client.interrupts.loop():
+                        return fn(*args, **kwargs, loop=loop_obj)
                 except Retry as e:
                     if logger and e.log_retry:
                         logger.info("resample and retry", extra={"rate": 1/5})
                     kwargs.update(e.kwargs or {})
+                except Interrupted:
+                    if logger:
+                        logger.info("interrupted, resample and retry")
                 loop_obj.new_sample()
         return loop
     return wrapper
@@ -393,3 +573,5 @@ def sample_from_file(key):
 
 
 config.add_option("utils:default-wait-timeout", type=float, min_value=0.1, max_value=100, default=10.)
+config.add_option("utils:match-workers", type=int, min_value=0, max_value=32, default=0)
+config.add_option("utils:match-ring-size", type=int, min_value=2, max_value=64, default=8)
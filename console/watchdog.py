@@ -1,8 +1,13 @@
 import logging
 import threading
 import time
-from console.utils import wait, click, click_mouse
-from console.client import client
+import cv2
+from console import threads
+from console.utils import templates, click, click_mouse, wait_while
+from console.client import client, ClientException
+from console.config import config
+from console.analyzer import analyzer
+from console.trace import trace
 
 try:
     import playsound
@@ -11,6 +16,7 @@ except ImportError:
 
 
 __all__ = (
+    "watchdog",
     "start_watchdog",
     "stop_watchdog",
 )
@@ -19,75 +25,223 @@ __all__ = (
 logger = logging.getLogger(__name__)
 
 
-def watchdog_runner():
-    logger.info("Watchdog started")
-
-    states = (
-        "common/hummer1",
-        "common/magnifier1",
-        "common/under_attack",
-        "common/after_attack",
-        "common/another_device",
-        "common/sleeping",
-        "common/captcha",
-    )
-
-    while _watchdog_thread is not None:
-        time.sleep(3)
-        if not client.connected:
-            continue
-        try:
-            state = wait(states, timeout=0, logger=logger, threshold=0.65)
-        except:
-            continue
-        if not state:
-            continue
-        if state == "common/hummer1":
-            logger.info("Hummer")
-            click_mouse(500, 400, rand_x=100, rand_y=100)
-            if playsound:
-                playsound.playsound("sounds/collect.mp3")
-        elif state == "common/magnifier1":
-            logger.info("Magnifier")
-            click_mouse(500, 400, rand_x=100, rand_y=100)
-            if playsound:
-                playsound.playsound("sounds/collect.mp3")
-        elif state == "common/under_attack":
-            logger.info("Under attack")
-            click("common/update_button", timeout=0, logger=logger)
-        elif state == "common/after_attack":
-            logger.info("After attack")
-            click("common/ok_button", timeout=0, logger=logger)
-        elif state == "common/another_device":
-            logger.info("Another device")
-            click("common/try_again_button", timeout=0, logger=logger)
-        elif state == "common/sleeping":
-            logger.info("I'm sleeping, really?")
-            click("common/sleeping_back", timeout=0, logger=logger)
-        elif state == "common/captcha":
-            logger.info("Captcha alarm!")
-            if playsound:
-                playsound.playsound("sounds/alarm.mp3")
-            else:
-                for x in range(6):
-                    time.sleep(1)
-                    print("\007")
+config.add_option("watchdog:frame-interval", type=int, min_value=1, max_value=1000, default=10)
+config.add_option("watchdog:full-frame-interval", type=int, min_value=1, max_value=10000, default=100)
+
+
+# grid step (pixels) of the change detector
+CHANGE_STEP = 8
+CHANGE_THRESHOLD = 24
+REGION_PADDING = 32
+THRESHOLD = 0.65
+CAPTCHA_TIMEOUT = 300
+
+
+def play_sound(filename):
+    # never block the watchdog while a sound is playing
+    if playsound:
+        threading.Thread(target=playsound.playsound, args=(filename,), daemon=True).start()
+        return True
+    return False
+
+
+def beep(count):
+    def run():
+        for x in range(count):
+            time.sleep(1)
+            print("\007")
+    threading.Thread(target=run, daemon=True).start()
+
+
+def on_hummer():
+    logger.info("Hummer")
+    click_mouse(500, 400, rand_x=100, rand_y=100)
+    play_sound("sounds/collect.mp3")
+
+
+def on_magnifier():
+    logger.info("Magnifier")
+    click_mouse(500, 400, rand_x=100, rand_y=100)
+    play_sound("sounds/collect.mp3")
+
+
+def on_under_attack():
+    logger.info("Under attack")
+    click("common/update_button", timeout=0, logger=logger)
+
+
+def on_after_attack():
+    logger.info("After attack")
+    click("common/ok_button", timeout=0, logger=logger)
+
 
-    logger.info("Watchdog stopped")
+def on_another_device():
+    logger.info("Another device")
+    click("common/try_again_button", timeout=0, logger=logger)
 
 
-_watchdog_thread = None
+def on_sleeping():
+    logger.info("I'm sleeping, really?")
+    click("common/sleeping_back", timeout=0, logger=logger)
+
+
+def on_captcha():
+    logger.info("Captcha alarm!")
+    if not play_sound("sounds/alarm.mp3"):
+        beep(6)
+    # keep the bot suspended until the captcha is solved
+    wait_while("common/captcha", timeout=CAPTCHA_TIMEOUT, threshold=THRESHOLD, can_trace=False)
+
+
+class Check:
+    """Popup check.
+    `region` (left, top, right, bottom) restricts the search, it is learned
+    from the first full-frame match when not given. Checks with a higher
+    `priority` are looked at first, the first match wins.
+    """
+
+    def __init__(self, name, handler, priority=0, region=None):
+        self.name = name
+        self.handler = handler
+        self.priority = priority
+        self.region = region
+
+    def find(self, key, sample, full=False):
+        region = None if full else self.region
+        return analyzer.find(key, sample, templates[self.name], region, THRESHOLD)
+
+    def learn(self, match, shape):
+        if self.region is None:
+            height, width = shape
+            self.region = (
+                max(match.left - REGION_PADDING, 0),
+                max(match.top - REGION_PADDING, 0),
+                min(match.right + REGION_PADDING + 1, width),
+                min(match.bottom + REGION_PADDING + 1, height)
+            )
+
+    def changed(self, mask):
+        left, top, right, bottom = self.region
+        return mask[top // CHANGE_STEP:bottom // CHANGE_STEP + 1,
+                    left // CHANGE_STEP:right // CHANGE_STEP + 1].any()
+
+
+def get_changes(sample, prev):
+    # coarse per-cell change mask, a popup appearing changes its cells
+    if prev is None:
+        return None
+    diff = cv2.absdiff(sample[::CHANGE_STEP, ::CHANGE_STEP], prev[::CHANGE_STEP, ::CHANGE_STEP])
+    return diff > CHANGE_THRESHOLD
+
+
+class Watchdog:
+    """Popup handlers of one client, run in a background thread."""
+
+    def __init__(self, client):
+        self.client = client
+        self.checks = []
+        self._thread = None
+        self._token = None
+
+    def add_check(self, name, handler, priority=0, region=None):
+        self.checks.append(Check(name, handler, priority, region))
+        # stable, so checks of the same priority keep their order
+        self.checks.sort(key=lambda check: -check.priority)
+
+    def analyze(self, key, sample, prev, periodic, full):
+        mask = get_changes(sample, prev)
+        for check in self.checks:
+            if check.region is None:
+                # not learned yet, a full-frame search is only affordable
+                # on the periodic ticks, not on every changed frame
+                wanted = full or periodic or mask is None
+            else:
+                wanted = full or periodic or mask is None or check.changed(mask)
+            if wanted:
+                match = check.find(key, sample, full=full)
+                if match:
+                    check.learn(match, sample.shape)
+                    return check
+        return None
+
+    def run(self, token):
+        logger.info("Watchdog started")
+        # handlers (the captcha one waits for minutes) are cancelled by stop()
+        with threads.token_context(token):
+            try:
+                self._run()
+            except threads.Cancelled:
+                pass
+        logger.info("Watchdog stopped")
+
+    def _run(self):
+        client = self.client
+        key = None
+        prev = None
+        count = 0
+        while self._thread is not None:
+            if not client.connected:
+                key = prev = None
+                threads.sleep(1)
+                continue
+            try:
+                # a background waiter: it sees every frame the bot asks for,
+                # and one per "client:idle-frame-interval" while the bot is idle
+                new_key = client.wait_frame(key, timeout=1, background=True)
+                if new_key is None:
+                    continue
+                key, sample = client.get_keyed_sample()
+            except ClientException:
+                continue
+            count += 1
+            periodic = count % config.get("watchdog:frame-interval") == 0
+            # popups may show up away from the learned regions, so look at
+            # the whole frame once in a while
+            full = count % config.get("watchdog:full-frame-interval") == 0
+            try:
+                check = self.analyze(key, sample, prev, periodic, full)
+            except Exception:
+                logger.exception("Watchdog check failed")
+                continue
+            prev = sample
+            if check:
+                # the bot is suspended at its next wait or gesture while the
+                # handler runs, and re-samples when resumed
+                with client.interrupts.interrupt(check.name):
+                    try:
+                        check.handler()
+                    except Exception:
+                        logger.exception("Watchdog handler failed")
+                        trace.dump("watchdog")
+                # the screen is changing now, look at it from scratch
+                prev = None
+
+    def start(self):
+        if not self._thread:
+            self._token = threads.CancelToken()
+            self._thread = threading.Thread(target=self.run, args=(self._token,), daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread:
+            thread, self._thread = self._thread, None
+            self._token.cancel()
+            thread.join()
+
+
+watchdog = Watchdog(client)
+watchdog.add_check("common/hummer1", on_hummer)
+watchdog.add_check("common/magnifier1", on_magnifier)
+watchdog.add_check("common/under_attack", on_under_attack, priority=2)
+watchdog.add_check("common/after_attack", on_after_attack, priority=1)
+watchdog.add_check("common/another_device", on_another_device, priority=2)
+watchdog.add_check("common/sleeping", on_sleeping, priority=1)
+watchdog.add_check("common/captcha", on_captcha, priority=3)
 
 
 def start_watchdog():
-    global _watchdog_thread
-    if not _watchdog_thread:
-        _watchdog_thread = threading.Thread(target=watchdog_runner, daemon=True)
-        _watchdog_thread.start()
+    watchdog.start()
 
 
 def stop_watchdog():
-    global _watchdog_thread
-    if _watchdog_thread:
-        thread, _watchdog_thread = _watchdog_thread, None
-        thread.join()
+    watchdog.stop()
@@ -1,4 +1,8 @@
 #!/usr/bin/env python3
 
 from console.ui import run_app
-run_app()
+
+
+# match pool workers are spawned and import the main module again
+if __name__ == "__main__":
+    run_app()
@@ -8,10 +8,38 @@ SERVER_BIT_RATE = 8000000
 SERVER_MAX_FPS = 0
 SCRSHARE_LOG_LEVEL = "INFO"
 SCRSHARE_RENDER_INTERVAL = 150
+# {server_port} and {receiver_port} may be added for scrshare builds that accept them
+SCRSHARE_ARGS = ["-i", "{interval}", "-l", "{log_level}"]
+# "scrshare" or "inprocess" (decode the scrcpy stream in the client, needs PyAV)
+STREAM_DECODER = "scrshare"
 SCREEN_WIDTH = 1280
 SCREEN_HEIGHT = 720
+# scrcpy server capture profiles, see console.capture.Profile
+CAPTURE_PROFILES = {
+    "full": {},
+    "low": {"max_size": 640, "bit_rate": 2000000, "max_fps": 15},
+}
+# capture rate while no arena session runs, the frame size is kept
+IDLE_CAPTURE = {"bit_rate": 1000000, "max_fps": 5}
 CONFIG_FILE = "bot_config.json"
 IMAGE_SEARCH_TRHESHOLD = 0.91
 TEMPLATE_DIR = "templates"
 SAMPLE_DIR = "samples"
 TRACE_DIR = "trace"
+UI_LOG_LINES = 5000
+UI_LOG_FLUSH_INTERVAL = 100
+UI_PREVIEW_WIDTH = 320
+UI_PREVIEW_FPS = 2
+UI_PREVIEW_MATCH_TTL = 2
+ADB_SERVER_HOST = "127.0.0.1"
+ADB_SERVER_PORT = 5037
+SERVER_READY_TIMEOUT = 10
+SCRSHARE_READY_TIMEOUT = 10
+CLIENT_READY_TIMEOUT = 5
+SUPERVISOR_CHECK_INTERVAL = 1
+SUPERVISOR_STALL_TIMEOUT = 10
+SUPERVISOR_BACKOFF = 2
+SUPERVISOR_MAX_BACKOFF = 120
+STARTUP_IMPORT_BUDGET = 500
+# UI executor lanes and how many jobs each may queue
+UI_LANES = {"device": 2, "analysis": 2, "ui": 2}
@@ -0,0 +1,136 @@
+import socket
+import struct
+import threading
+
+
+class AdbStub(threading.Thread):
+    """Minimal adb server for tests.
+
+    Host requests get OKAY and the answer from `responses`, or FAIL for
+    unknown services and those in `fail`. `sync:` sessions accept
+    SEND/DATA/DONE pushes into `files` until QUIT.
+    """
+
+    def __init__(self, serial="emulator-5554", responses=None, fail=()):
+        super().__init__(daemon=True)
+        self.serial = serial
+        self.responses = {
+            "host:version": "0029",
+            "host:devices": "%s\tdevice\n" % serial,
+        }
+        self.responses.update(responses or {})
+        self.fail = set(fail)
+        self.requests = []
+        self.files = {}
+        self.connections = 0
+        self._sessions = []
+        self._lock = threading.Lock()
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+
+    def run(self):
+        while 1:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with self._lock:
+                self.connections += 1
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def close(self):
+        self.sock.close()
+        self.drop_sessions()
+
+    def drop_sessions(self):
+        """Close open sync sessions, as adb does when a device goes away."""
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+        for conn in sessions:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _serve(self, conn):
+        with conn:
+            try:
+                self._handle(conn)
+            except (OSError, EOFError):
+                pass
+
+    def _handle(self, conn):
+        while 1:
+            request = recv_exactly(conn, int(recv_exactly(conn, 4), 16)).decode("utf-8")
+            self.requests.append(request)
+            if request in self.fail:
+                send_fail(conn, "%s failed" % request)
+                return
+            if request.startswith("host:transport:"):
+                if request[len("host:transport:"):] != self.serial:
+                    send_fail(conn, "device not found")
+                    return
+                conn.sendall(b"OKAY")
+                continue
+            if request == "sync:":
+                conn.sendall(b"OKAY")
+                with self._lock:
+                    self._sessions.append(conn)
+                self._sync(conn)
+                return
+            if request.startswith("shell:"):
+                conn.sendall(b"OKAY" + self.responses.get(request, "").encode("utf-8"))
+                return
+            if ":forward:" in request:
+                conn.sendall(b"OKAYOKAY")
+                return
+            if request in self.responses:
+                data = self.responses[request].encode("utf-8")
+                conn.sendall(b"OKAY" + b"%04x" % len(data) + data)
+                return
+            send_fail(conn, "unknown service %s" % request)
+            return
+
+    def _sync(self, conn):
+        while 1:
+            command, size = struct.unpack("<4sI", recv_exactly(conn, 8))
+            if command == b"QUIT":
+                return
+            if command != b"SEND":
+                send_sync_fail(conn, "unexpected %r" % command)
+                return
+            path = recv_exactly(conn, size).decode("utf-8").rsplit(",", 1)[0]
+            data = bytearray()
+            while 1:
+                command, size = struct.unpack("<4sI", recv_exactly(conn, 8))
+                if command == b"DATA":
+                    data.extend(recv_exactly(conn, size))
+                elif command == b"DONE":
+                    break
+                else:
+                    send_sync_fail(conn, "unexpected %r" % command)
+                    return
+            self.files[path] = bytes(data)
+            conn.sendall(b"OKAY" + struct.pack("<I", 0))
+
+
+def recv_exactly(conn, size):
+    data = bytearray()
+    while len(data) < size:
+        packet = conn.recv(size - len(data))
+        if not packet:
+            raise EOFError()
+        data.extend(packet)
+    return bytes(data)
+
+
+def send_fail(conn, message):
+    data = message.encode("utf-8")
+    conn.sendall(b"FAIL" + b"%04x" % len(data) + data)
+
+
+def send_sync_fail(conn, message):
+    data = message.encode("utf-8")
+    conn.sendall(b"FAIL" + struct.pack("<I", len(data)) + data)
@@ -0,0 +1,112 @@
+import os
+import socket
+import tempfile
+import unittest
+from unittest import mock
+from console import adb
+from console.adbclient import AdbClient, AdbError, AdbConnectionError
+from tests.adbstub import AdbStub
+
+
+SERIAL = "emulator-5554"
+
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class AdbClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = AdbStub(SERIAL, responses={"shell:echo hi": "hi\n"}, fail=("host:connect:bad",))
+        self.stub.start()
+        self.client = AdbClient("127.0.0.1", self.stub.port, timeout=2.)
+        fd, self.local_path = tempfile.mkstemp()
+        with os.fdopen(fd, "wb") as f:
+            # several DATA chunks
+            f.write(os.urandom(150 * 1024))
+        with open(self.local_path, "rb") as f:
+            self.content = f.read()
+
+    def tearDown(self):
+        self.client.close()
+        self.stub.close()
+        os.unlink(self.local_path)
+
+    def test_host_requests(self):
+        self.assertEqual(self.client.version(), 0x29)
+        self.assertEqual(self.client.devices(), [[SERIAL, "device"]])
+        self.assertEqual(self.client.shell(SERIAL, "echo hi"), "hi\n")
+        self.assertTrue(self.client.forward(SERIAL, "tcp:27183", "localabstract:scrcpy"))
+
+    def test_fail(self):
+        with self.assertRaisesRegex(AdbError, "host:connect:bad failed"):
+            self.client.connect("bad")
+        with self.assertRaisesRegex(AdbError, "device not found"):
+            self.client.shell("other", "echo hi")
+
+    def test_push_reuses_sync_session(self):
+        self.client.push(SERIAL, self.local_path, "/data/local/tmp/a")
+        self.client.push(SERIAL, self.local_path, "/data/local/tmp/b")
+        self.assertEqual(self.stub.files["/data/local/tmp/a"], self.content)
+        self.assertEqual(self.stub.files["/data/local/tmp/b"], self.content)
+        self.assertEqual(self.stub.connections, 1)
+        self.assertEqual(self.stub.requests, ["host:transport:" + SERIAL, "sync:"])
+
+    def test_push_retries_stale_session(self):
+        self.client.push(SERIAL, self.local_path, "/data/local/tmp/a")
+        self.stub.drop_sessions()
+        self.client.push(SERIAL, self.local_path, "/data/local/tmp/b")
+        self.assertEqual(self.stub.files["/data/local/tmp/b"], self.content)
+        self.assertEqual(self.stub.connections, 2)
+
+    def test_no_server(self):
+        client = AdbClient("127.0.0.1", closed_port(), timeout=1.)
+        with self.assertRaises(AdbConnectionError):
+            client.version()
+        self.assertFalse(client.available())
+
+
+class FallbackTest(unittest.TestCase):
+
+    def test_adb_executable_without_server(self):
+        client = AdbClient("127.0.0.1", closed_port(), timeout=1.)
+        with mock.patch.object(adb, "adb_client", client), \
+                mock.patch.object(adb, "run_command", return_value=True) as run_command:
+            self.assertTrue(adb.push_server(SERIAL))
+        args = run_command.call_args[0][0]
+        self.assertEqual(args[:4], ["adb", "-s", SERIAL, "push"])
+
+    def test_server_errors_are_not_retried(self):
+        stub = AdbStub("other")
+        stub.start()
+        try:
+            client = AdbClient("127.0.0.1", stub.port, timeout=2.)
+            with mock.patch.object(adb, "adb_client", client), \
+                    mock.patch.object(adb, "run_command") as run_command:
+                self.assertFalse(adb.push_server(SERIAL))
+            run_command.assert_not_called()
+        finally:
+            stub.close()
+
+    def test_server_push(self):
+        stub = AdbStub(SERIAL)
+        stub.start()
+        try:
+            client = AdbClient("127.0.0.1", stub.port, timeout=2.)
+            with mock.patch.object(adb, "adb_client", client), \
+                    mock.patch.object(adb, "run_command") as run_command, \
+                    mock.patch.object(adb.settings, "ADB_SERVER_FILENAME", __file__):
+                self.assertTrue(adb.push_server(SERIAL))
+                client.close()
+            run_command.assert_not_called()
+            with open(__file__, "rb") as f:
+                self.assertEqual(stub.files[adb.settings.ADB_DEVICE_SERVER_PATH], f.read())
+        finally:
+            stub.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import time
+import struct
+import threading
+import unittest
+from unittest import mock
+from console import utils
+from console.capture import Profile
+from console.client import Client
+
+
+# pack_mouse_event() message
+TOUCH_EVENT = struct.Struct(">BBqLLHHHL")
+
+
+class FakeSocket:
+    def __init__(self):
+        self.events = []
+
+    def send(self, data):
+        self.events.append(TOUCH_EVENT.unpack(data))
+
+
+class CropClickTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = Client()
+        # right half of the screen
+        self.client.geometry = Profile("right", crop=(640, 0, 640, 720)).geometry()
+        self.client._control_socket = FakeSocket()
+        patcher = mock.patch.object(utils, "client", self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def positions(self):
+        return [(event[3], event[4]) for event in self.client._control_socket.events]
+
+    def test_click_inside_crop(self):
+        utils.click_mouse(1160, 380)
+        self.assertEqual(self.positions(), [(520, 380), (520, 380)])
+
+    def test_click_outside_crop(self):
+        self.assertIsNone(utils.click_mouse(500, 400, rand_x=100, rand_y=100))
+        utils.mouse_move(50, 50, 1230, 50)
+        self.assertEqual(self.positions(), [])
+
+    def test_jitter_stays_in_frame(self):
+        for _ in range(5):
+            utils.click_mouse(641, 1, rand_x=50, rand_y=50)
+        for x, y in self.positions():
+            self.assertTrue(0 <= x < 640 and 0 <= y < 720)
+
+    def test_click_dropped_after_interrupt(self):
+        result = []
+        with self.client.interrupts.interrupt("popup"):
+            thread = threading.Thread(target=lambda: result.append(utils.click_mouse(1160, 380)))
+            thread.start()
+            time.sleep(0.1)
+        thread.join()
+        self.assertEqual(result, [None])
+        self.assertEqual(self.positions(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
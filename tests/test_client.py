@@ -0,0 +1,69 @@
+import time
+import threading
+import unittest
+from console.capture import Geometry
+from console.client import Client
+from console.watchdog import Watchdog
+
+
+FRAME_INTERVAL = 0.01
+
+
+class IdleFramesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = Client()
+        self.client.geometry = Geometry((0, 0, 64, 32))
+        self.client._frame_cond = threading.Condition()
+        self.client._connected = True
+        self.addCleanup(setattr, self.client, "_connected", False)
+
+    def stream(self, duration):
+        """Feed frames the way the receiver does, return (pushed, skipped)."""
+        pushed = skipped = 0
+        data = bytes(64 * 32)
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            if self.client._frame_wanted():
+                pushed += 1
+                self.client._push_frame(pushed, 64, 32, data)
+            else:
+                skipped += 1
+                self.client._skip_frame()
+            time.sleep(FRAME_INTERVAL)
+        return pushed, skipped
+
+    def test_idle_frames_skipped_with_watchdog(self):
+        watchdog = Watchdog(self.client)
+        seen = []
+        watchdog.analyze = lambda key, *args: seen.append(key)
+        watchdog.start()
+        try:
+            pushed, skipped = self.stream(1.)
+        finally:
+            watchdog.stop()
+        self.assertGreater(skipped, pushed * 3)
+        # the watchdog still looks at the screen while idle
+        self.assertGreaterEqual(len(seen), 2)
+
+    def test_waiter_gets_every_frame(self):
+        keys = []
+
+        def bot():
+            key = None
+            while len(keys) < 10:
+                key = self.client.wait_frame(key, timeout=1)
+                if key is None:
+                    break
+                keys.append(key)
+
+        thread = threading.Thread(target=bot)
+        thread.start()
+        time.sleep(0.05)
+        pushed, skipped = self.stream(0.3)
+        thread.join()
+        self.assertEqual(len(keys), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import time
+import threading
+import unittest
+from unittest import mock
+import numpy as np
+from console import threads
+from console.interrupts import Interrupts
+from console.watchdog import Watchdog, Check
+
+
+SHAPE = (720, 1280)
+
+
+def handler():
+    pass
+
+
+class AnalyzeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.watchdog = Watchdog(client=None)
+        self.watchdog.add_check("common/under_attack", handler, region=(100, 100, 300, 200))
+        self.watchdog.add_check("common/captcha", handler)
+        self.prev = np.zeros(SHAPE, dtype=np.uint8)
+        self.found = []
+        patcher = mock.patch.object(Check, "find", lambda check, key, sample, full=False: self.found.append(
+            (check.name, full)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def changed(self, left, top, right, bottom):
+        sample = self.prev.copy()
+        sample[top:bottom, left:right] = 255
+        return sample
+
+    def test_change_outside_regions(self):
+        sample = self.changed(800, 500, 900, 600)
+        self.assertIsNone(self.watchdog.analyze(1, sample, self.prev, periodic=False, full=False))
+        self.assertEqual(self.found, [])
+
+    def test_change_inside_region(self):
+        sample = self.changed(150, 120, 200, 160)
+        self.watchdog.analyze(1, sample, self.prev, periodic=False, full=False)
+        self.assertEqual(self.found, [("common/under_attack", False)])
+
+    def test_periodic_searches_unlearned(self):
+        self.watchdog.analyze(1, self.prev, self.prev, periodic=True, full=False)
+        self.assertEqual(sorted(self.found), [("common/captcha", False), ("common/under_attack", False)])
+
+
+class FakeClient:
+    connected = True
+
+    def __init__(self):
+        self.interrupts = Interrupts()
+
+    def wait_frame(self, key=None, timeout=None, background=False):
+        threads.sleep(0.01)
+        return (key or 0) + 1
+
+    def get_keyed_sample(self):
+        return 1, None
+
+
+class StopTest(unittest.TestCase):
+
+    def test_stop_cancels_handler(self):
+        started = threading.Event()
+
+        def captcha():
+            started.set()
+            threads.sleep(300)
+
+        watchdog = Watchdog(FakeClient())
+        check = Check("common/captcha", captcha)
+        watchdog.analyze = lambda *args: check
+        watchdog.start()
+        self.assertTrue(started.wait(2))
+        tm = time.monotonic()
+        watchdog.stop()
+        self.assertLess(time.monotonic() - tm, 1)
+        self.assertIsNone(watchdog.client.interrupts.active)
+
+
+if __name__ == "__main__":
+    unittest.main()